@@ -0,0 +1,84 @@
+#!/usr/bin/env python2
+"""
+Measures the memory held by the jobs of a workflow
+
+A workflow of 10,000 jobs, each with two inputs and two outputs (one of them
+a directory), is generated twice from the same JSON and the deep size of its
+jobs is reported per job for the first workflow and for the second copy,
+which shares the interned paths of the first.
+"""
+import argparse
+import json
+import os
+import sys
+
+SCRIPT_PATH = os.path.dirname(__file__)
+sys.path.insert(0, os.path.abspath(os.path.join(SCRIPT_PATH, '..', '..')))
+
+from yerba.workflow import Workflow
+
+def deep_size(obj, seen):
+    '''Returns the size of the object and everything it holds not yet seen'''
+    if id(obj) in seen:
+        return 0
+
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+
+    if isinstance(obj, dict):
+        size += sum(deep_size(key, seen) + deep_size(value, seen)
+                    for (key, value) in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_size(item, seen) for item in obj)
+    else:
+        if hasattr(obj, '__dict__'):
+            size += deep_size(obj.__dict__, seen)
+
+        for cls in type(obj).__mro__:
+            for name in getattr(cls, '__slots__', ()):
+                if hasattr(obj, name):
+                    size += deep_size(getattr(obj, name), seen)
+
+    return size
+
+def generate_jobs(count):
+    '''Returns the jobs of the workflow as JSON'''
+    jobs = []
+
+    for index in range(count):
+        jobs.append({
+            'cmd': 'nice',
+            'script': None,
+            'description': 'job %d' % index,
+            'args': [['-n', str(index), 0]],
+            'inputs': [u'/data/genomes/shared/genome.fasta',
+                       u'/data/out/%d.in' % (index // 2)],
+            'outputs': [u'/data/out/%d.out' % index,
+                        [u'/data/out/dir%d' % index, 1]],
+            'options': {'retries': 1} if index % 10 == 0 else {},
+        })
+
+    return json.dumps(jobs)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--jobs', type=int, default=10000,
+                        help='number of jobs in the workflow')
+    args = parser.parse_args()
+
+    text = generate_jobs(args.jobs)
+    workflows = [Workflow.from_object({'name': 'benchmark',
+                                       'jobs': json.loads(text)})
+                 for _ in range(2)]
+
+    seen = set()
+    first = deep_size(workflows[0].jobs, seen)
+    second = deep_size(workflows[1].jobs, seen)
+
+    print 'jobs: %d' % args.jobs
+    print 'first workflow: %.0f bytes/job' % (first / float(args.jobs))
+    print 'second identical workflow: %.0f bytes/job' % (
+        second / float(args.jobs))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python2
+"""
+Measures the time taken to check whether a job is ready
+
+A job with four inputs and the same four files as its outputs is checked
+with a warm stat cache, using the default options, a retries override and
+allow-zero-length turned off. The best of the repeats is reported per call.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+SCRIPT_PATH = os.path.dirname(__file__)
+sys.path.insert(0, os.path.abspath(os.path.join(SCRIPT_PATH, '..', '..')))
+
+from yerba.workflow import Job
+
+OPTIONS = (
+    ('default options', {}),
+    ('retries override', {'retries': 1}),
+    ('allow-zero-length false', {'allow-zero-length': False}),
+)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--number', type=int, default=200000,
+                        help='calls timed in each repeat')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='number of repeats')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+
+    try:
+        files = [os.path.join(directory, 'file%d' % index)
+                 for index in range(4)]
+
+        for path in files:
+            with open(path, 'w') as handle:
+                handle.write('x')
+
+        for (label, options) in OPTIONS:
+            job = Job.from_object({'cmd': 'cmd', 'script': None,
+                                   'inputs': files, 'outputs': files,
+                                   'options': options})
+
+            #: Warm the stat cache
+            job.ready()
+            job.completed()
+
+            best = min(timeit.repeat(job.ready, number=args.number,
+                                     repeat=args.repeat))
+            print '%s: %.1f us/call' % (label, best / args.number * 1e6)
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
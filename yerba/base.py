@@ -2,14 +2,22 @@
 import atexit
 import json
 import logging
+import signal
+from itertools import islice
 from pprint import pformat
-from time import sleep
+from Queue import Queue
+from threading import Thread
 
 import zmq
+from yerba import utils
 from yerba.core import (status_message, status_name, EventNotifier,
-                        SCHEDULE_TASK, CANCEL_TASK, TASK_DONE)
-from yerba.managers import (ServiceManager, WorkflowManager)
-from yerba.routes import (route, dispatch)
+                        SCHEDULE_TASK, CANCEL_TASK, TASK_DONE,
+                        WORKFLOW_CHANGED)
+from yerba.db import StoreService
+from yerba.events import Publisher
+from yerba.managers import (ServiceManager, WorkflowManager,
+                            WorkflowService)
+from yerba.routes import (route, dispatch, is_readonly, Stream)
 from yerba.workflow import WorkflowError
 from yerba.workqueue import WorkQueueService
 
@@ -18,91 +26,239 @@ access = logging.getLogger('access')
 running = True
 decoder = json.JSONDecoder()
 
+REPLIES = "inproc://yerba-replies"
+
+#: Fields of a workflow that can be returned by the workflows route
+WORKFLOW_FIELDS = ('id', 'name', 'submitted', 'completed', 'status', 'priority',
+                   'summary')
+DEFAULT_WORKFLOW_FIELDS = ('id', 'name', 'submitted', 'completed', 'status')
+STREAM_CHUNK = 500
+
 def listen_forever(config):
+    utils.stat_cache.configure(ttl=config.getfloat('yerba', 'stat_ttl'),
+                               size=config.getint('yerba', 'stat_cache_size'))
+    utils.log_writer.configure(
+        size=config.getint('yerba', 'log_queue_size'),
+        handles=config.getint('yerba', 'log_handles'),
+        interval=config.getfloat('yerba', 'log_flush_interval'))
+    utils.log_writer.start()
+
     notifier = EventNotifier()
+    WorkflowManager.connect(config.get('db', 'path'),
+                            storage=config.get('db', 'storage'),
+                            flush_interval=config.getint('db', 'flush_interval'))
     wq = WorkQueueService(dict(config.items('workqueue')), notifier)
     ServiceManager.register(wq)
+    ServiceManager.register(StoreService(WorkflowManager.store))
+    ServiceManager.register(WorkflowService())
+    WorkflowManager.set_eviction(
+        evict_after=config.getint('yerba', 'evict_after'),
+        max_finished=config.getint('yerba', 'max_finished'),
+        max_finished_jobs=config.getint('yerba', 'max_finished_jobs'))
+    WorkflowManager.set_retries(
+        delay=config.getint('yerba', 'retry_delay'),
+        max_delay=config.getint('yerba', 'max_retry_delay'))
+    WorkflowManager.set_recovery(
+        batch=config.getint('yerba', 'recovery_batch'))
+
+    #: Changes to workflows are published when a port is configured
+    publish_port = config.get('yerba', 'publish_port')
+
+    if publish_port:
+        publisher = Publisher(publish_port)
+        ServiceManager.register(publisher)
+        notifier.register(WORKFLOW_CHANGED, publisher.publish)
+
     ServiceManager.start()
-    WorkflowManager.connect(config.get('db', 'path'))
     WorkflowManager.set_notifier(notifier)
-    WorkflowManager.cleanup()
+    WorkflowManager.cleanup(recovery=config.get('yerba', 'recovery'))
 
     #: Register for events to be notified by
-    notifier.register(TASK_DONE, WorkflowManager.update)
+    notifier.register(TASK_DONE, WorkflowManager.complete)
     notifier.register(CANCEL_TASK, wq.cancel)
     notifier.register(SCHEDULE_TASK, wq.schedule)
 
     connection_string = "tcp://*:{}".format(config.get('yerba', 'port'))
     context = zmq.Context()
-    socket = context.socket(zmq.REP)
-    socket.set(zmq.LINGER, 0)
-    socket.bind(connection_string)
+    frontend = context.socket(zmq.ROUTER)
+    frontend.set(zmq.LINGER, 0)
+    frontend.bind(connection_string)
+
+    #: Responses from the reader threads are sent back through this thread
+    replies = context.socket(zmq.PULL)
+    replies.set(zmq.LINGER, 0)
+    replies.bind(REPLIES)
+
+    #: Read-only requests are served by a pool of reader threads
+    readers = Queue()
+
+    for index in range(config.getint('yerba', 'workers')):
+        reader = Thread(target=read_forever, args=(context, readers),
+                        name="reader-{}".format(index))
+        reader.daemon = True
+        reader.start()
+
     poller = zmq.Poller()
-    poller.register(socket, zmq.POLLIN)
+    poller.register(frontend, zmq.POLLIN)
+    poller.register(replies, zmq.POLLIN)
     atexit.register(shutdown)
+    signal.signal(signal.SIGTERM, terminate)
+
+    #: Upper bound on how long the loop blocks waiting for a request
+    #: before it checks the work queue for completed tasks again.
+    poll_timeout = config.getint('yerba', 'poll_timeout')
+
+    #: Maximum number of requests served before the services are updated
+    max_requests = config.getint('yerba', 'max_requests')
+
+    timeout = 0
 
     while running:
+        requests = 0
+        completed = 0
+
         try:
-            if socket in dict(poller.poll(timeout=10)):
-                msg = None
-                response = None
-
-                try:
-                    data = socket.recv_string()
-                    msg = decoder.decode(data)
-                    access.debug("ZMQ: Recieved \n%s", pformat(msg))
-                except Exception:
-                    logger.exception("ZMQ: The message was not parsed")
-
-                if not msg:
-                    logger.warn("The message was not recieved.")
-                else:
-                    try:
-                        response = dispatch(msg)
-                    except:
-                        logger.exception("EXCEPTION")
-
-                if not response:
-                    logger.info("Invalid request")
-                    response = {"status" : "Failed", "error": "Invalid response"}
-
-                try:
-                    message = json.dumps(response, encoding="utf-8", ensure_ascii=False)
-                except Exception:
-                    message = json.dumps({"status": "Failed", "error": "Invalid json"})
-                    logger.exception("INVALID JSON RESPONSE:\n %s", pformat(response))
-
-                try:
-                    access.info("Sending Response")
-                    socket.send_unicode(message, flags=zmq.NOBLOCK)
-                except zmq.Again:
-                    logger.exception("Failed to respond with response %s",
-                        response)
-                finally:
-                    access.info("Finished processing the response")
-            else:
-                try:
-                    ServiceManager.update()
-                except:
-                    logger.exception("WORKQUEUE: Update error occured")
+            #: Block only when the previous iteration found nothing to do
+            while requests < max_requests:
+                events = dict(poller.poll(timeout=timeout))
+
+                if not events:
+                    break
+
+                if replies in events:
+                    send(frontend, replies.recv_multipart())
+
+                if frontend in events:
+                    receive(frontend, readers)
+
+                requests += 1
+                timeout = 0
+
+            try:
+                completed = ServiceManager.update()
+            except:
+                logger.exception("WORKQUEUE: Update error occured")
         except:
             logger.exception("EXPERIENCED AN ERROR!")
 
-        # Sleep for 5 milliseconds
-        sleep(0.05)
+        #: Back off exponentially while idle so that completions are still
+        #: noticed within poll_timeout milliseconds
+        if requests or completed:
+            timeout = 0
+        else:
+            timeout = min(max(timeout * 2, 1), poll_timeout)
+
+def read_forever(context, readers):
+    '''
+    Serves read-only requests from the queue of readers.
+
+    Responses are pushed back to the scheduler thread which owns the
+    frontend socket.
+    '''
+    replies = context.socket(zmq.PUSH)
+    replies.set(zmq.LINGER, 0)
+    replies.connect(REPLIES)
+
+    while True:
+        (envelope, msg) = readers.get()
 
+        try:
+            replies.send_multipart(envelope + respond(msg))
+        except:
+            logger.exception("READER: Failed to serve the request")
+
+def receive(frontend, readers):
+    '''
+    Reads a single request from the frontend.
+
+    Read-only requests are queued for the reader threads and all others are
+    served immediately by the scheduler thread.
+    '''
+    frames = frontend.recv_multipart()
+    (envelope, data) = (frames[:-1], frames[-1])
+    msg = None
+
+    try:
+        msg = decoder.decode(data.decode('utf-8'))
+        access.debug("ZMQ: Recieved \n%s", pformat(msg))
+    except Exception:
+        logger.exception("ZMQ: The message was not parsed")
+
+    if msg and is_readonly(msg):
+        readers.put((envelope, msg))
+    else:
+        send(frontend, envelope + respond(msg))
+
+def respond(msg):
+    '''Returns the encoded frames of the response to the request'''
+    response = None
+
+    if not msg:
+        logger.warn("The message was not recieved.")
+    else:
+        try:
+            response = dispatch(msg)
+        except:
+            logger.exception("EXCEPTION")
+
+    if not response:
+        logger.info("Invalid request")
+        response = {"status" : "Failed", "error": "Invalid response"}
+
+    if not isinstance(response, Stream):
+        return [encode(response)]
+
+    try:
+        return [encode(part) for part in response]
+    except:
+        logger.exception("Failed to stream the response")
+        return [encode({"status" : "Failed", "error": "Invalid response"})]
+
+def encode(response):
+    '''Returns the response encoded as json'''
+    try:
+        message = json.dumps(response, encoding="utf-8", ensure_ascii=False)
+    except Exception:
+        message = json.dumps({"status": "Failed", "error": "Invalid json"})
+        logger.exception("INVALID JSON RESPONSE:\n %s", pformat(response))
+
+    if isinstance(message, unicode):
+        message = message.encode('utf-8')
+
+    return message
+
+def send(frontend, frames):
+    '''Sends the response frames to the client'''
+    try:
+        access.info("Sending Response")
+        frontend.send_multipart(frames, flags=zmq.NOBLOCK)
+    except zmq.Again:
+        logger.exception("Failed to respond with response %s", frames[-1])
+    finally:
+        access.info("Finished processing the response")
+
+
+def terminate(signum, frame):
+    '''Stops the main loop so the daemon exits cleanly'''
+    global running
+    running = False
 
 @route("shutdown")
-def shutdown():
+def shutdown(data=None):
     '''Shutdowns down the daemon'''
+    global running
     running = False
     ServiceManager.stop()
+    utils.log_writer.stop()
 
 #XXX: Add reporting information
-@route("health")
+@route("health", readonly=True)
 def get_health(data):
     access.info("#### HEALTH CHECK #####")
-    return  {"status" : "OK" }
+    wq = ServiceManager.get("workqueue", "scheduler")
+
+    return  {"status" : "OK", "stat_cache": utils.stat_cache.stats(),
+             "queue": wq.depth() if wq else None}
 
 @route("new")
 def create_workflow(data):
@@ -123,6 +279,26 @@ def schedule_workflow(data):
         "errors": errors
     }
 
+@route("schedule_batch")
+def schedule_workflows(data):
+    '''Schedules each of the workflows and returns their ids'''
+    access.info("##### BATCH WORKFLOW SCHEDULING #####")
+    workflows = (data or {}).get('workflows')
+
+    if not isinstance(workflows, list):
+        return {"status": "Failed", "error": "Invalid workflows"}
+
+    results = WorkflowManager.submit_batch(workflows)
+
+    return {
+        "status" : "OK",
+        "workflows" : [{
+            "status" : status_name(status),
+            "id": workflow_id,
+            "errors": errors
+        } for (workflow_id, status, errors) in results]
+    }
+
 @route("restart")
 def restart_workflow(data):
     '''Restart the job if it is running. Otherwise return NotFound'''
@@ -148,34 +324,159 @@ def cancel_workflow(data):
     except KeyError:
         return {"status" : 'NotFound'}
 
-@route("workflows")
+@route("workflows", readonly=True)
 def get_workflows(data):
-    '''Return all matching workflows'''
+    '''
+    Return all matching workflows
+
+    When a limit is given the workflows are returned newest first with the
+    cursor of the next page. When stream is set the workflows are sent as a
+    multipart response of chunks.
+    '''
     access.info("##### FETCHING WORKFLOWS #####")
-    ids = None
-    status = None
+    data = data or {}
+    fields = data.get('fields') or DEFAULT_WORKFLOW_FIELDS
+    limit = data.get('limit')
+    chunk = data.get('chunk', STREAM_CHUNK)
+
+    if any(field not in WORKFLOW_FIELDS for field in fields):
+        return {"status": "Failed", "error": "Invalid field"}
+
+    for (name, value) in (('limit', limit), ('chunk', chunk),
+                          ('cursor', data.get('cursor'))):
+        if value is not None and not is_positive(value):
+            return {"status": "Failed", "error": "Invalid {}".format(name)}
+
+    #: An extra workflow is fetched to find out if there is another page
+    workflows = WorkflowManager.get_workflows(
+        ids=data.get('ids'),
+        status=data.get('status'),
+        cursor=data.get('cursor'),
+        limit=limit + 1 if limit else None,
+        submitted=(data.get('submitted_after'), data.get('submitted_before')),
+        completed=(data.get('completed_after'), data.get('completed_before')),
+        name=data.get('name'),
+        priority=data.get('priority'))
+
+    if data.get('stream'):
+        return Stream(stream_workflows(workflows, fields, limit, chunk))
+
+    rows = list(islice(workflows, limit) if limit else workflows)
+    response = {"workflows" : [project(row, fields) for row in rows]}
+
+    if limit:
+        response["cursor"] = next_cursor(workflows, rows[-1] if rows else None)
+
+    return response
+
+def is_positive(value):
+    '''Returns whether the value is a positive integer'''
+    return (isinstance(value, (int, long)) and not isinstance(value, bool)
+            and value > 0)
+
+def stream_workflows(workflows, fields, limit, chunk):
+    '''
+    Yields the parts of a streamed workflows response
+
+    The fields are sent first, followed by chunks of workflows and the
+    cursor of the next page.
+    '''
+    yield {"fields": fields}
 
-    if data:
-        ids = data.get('ids', [])
-        status = data.get('status', None)
+    rows = islice(workflows, limit) if limit else workflows
+    last = None
 
-    workflows = WorkflowManager.get_workflows(ids, status)
-    result = []
+    while True:
+        part = list(islice(rows, chunk))
 
-    for (workflow_id, name, start, stop, status, priority) in workflows:
-        status_message = status_name(status)
-        result.append((workflow_id, name, start, stop, status_message))
+        if not part:
+            break
 
-    return { "workflows" : result }
+        last = part[-1]
+        yield {"workflows": [project(row, fields) for row in part]}
 
-@route("get_status")
+    yield {"cursor": next_cursor(workflows, last) if limit else None}
+
+def project(row, fields):
+    '''Returns the fields of the workflow'''
+    workflow = dict(zip(WORKFLOW_FIELDS, row))
+    workflow['status'] = status_name(workflow['status'])
+
+    #: The summary is stored once the workflow is evicted from memory
+    if 'summary' in fields:
+        summary = WorkflowManager.summary(workflow['id'])
+
+        if summary is None and workflow['summary']:
+            summary = decoder.decode(workflow['summary'])
+
+        workflow['summary'] = summary
+
+    return [workflow[field] for field in fields]
+
+def next_cursor(workflows, last):
+    '''Returns the cursor of the next page if there are workflows left'''
+    if last is not None and next(workflows, None) is not None:
+        return last[0]
+
+    return None
+
+@route("get_status", readonly=True)
 def get_workflow_status(data):
-    '''Gets the status of the workflow.'''
+    '''
+    Gets the status of the workflow.
+
+    Only the summary is returned when summary is set and only the jobs
+    changed after a version are returned when since is given.
+    '''
     access.info("##### WORKFLOW STATUS CHECK #####")
+    since = (data or {}).get('since')
+
+    if since is not None and not isinstance(since, (int, long)):
+        return {"status" : "Failed", "error": "Invalid version"}
+
     try:
         identity = data['id']
-        (status, jobs) = WorkflowManager.status(identity)
+        (status, jobs, summary, version) = WorkflowManager.status(
+            identity, output=data.get('output'),
+            jobs=not data.get('summary'), since=since,
+            fields=data.get('fields'))
         logger.info(status_message(identity, status))
-        return {"status" : status_name(status), "jobs" : jobs}
     except KeyError:
-        return {"status" : 'NotFound', "jobs" : {}}
+        return {"status" : 'NotFound', "jobs" : {}, "summary" : {}}
+
+    response = {"status" : status_name(status), "summary" : summary,
+                "version" : version}
+
+    if jobs is None:
+        return response
+
+    response["jobs" if since is None else "changes"] = jobs
+    return response
+
+@route("snapshot", readonly=True)
+def get_snapshot(data):
+    '''
+    Returns the state of a workflow or of every workflow in memory
+
+    The sequence number of the last message published is returned so that
+    subscribers can discard the messages that the snapshot includes.
+    '''
+    access.info("##### WORKFLOW SNAPSHOT #####")
+    data = data or {}
+    publisher = ServiceManager.get("publisher", "events")
+
+    with WorkflowManager.lock:
+        sequence = publisher.sequence if publisher else None
+
+        if 'id' not in data:
+            return {"sequence": sequence,
+                    "workflows": WorkflowManager.summaries()}
+
+        try:
+            (status, jobs, summary, version) = WorkflowManager.status(
+                data['id'])
+        except KeyError:
+            return {"status" : 'NotFound', "sequence": sequence}
+
+    return {"status" : status_name(status), "jobs" : jobs,
+            "summary" : summary, "version" : version, "sequence": sequence}
@@ -42,6 +42,7 @@ def status_message(name, code):
 SCHEDULE_TASK = 'schedule'
 CANCEL_TASK = 'cancel'
 TASK_DONE = 'done'
+WORKFLOW_CHANGED = 'changed'
 
 class EventNotifier(object):
     def __init__(self):
@@ -1,9 +1,21 @@
 # -*- coding: utf-8 -*-
-from json import JSONEncoder
-from sqlite3 import connect, IntegrityError
+from contextlib import contextmanager
+from hashlib import sha1
+from json import JSONEncoder, loads
+from logging import getLogger
+from sqlite3 import Binary, connect, IntegrityError
+from threading import Lock, local
 from time import time
+from uuid import uuid4
+import zlib
 
 from yerba.core import Status, status_code
+from yerba.services import Service
+
+logger = getLogger('yerba.db')
+
+#: Workflows hashed at once when an existing database is upgraded
+MIGRATE_BATCH_SIZE = 500
 
 CREATE_TABLE_QUERY = '''
     CREATE TABLE IF NOT EXISTS workflows
@@ -14,9 +26,67 @@ CREATE_TABLE_QUERY = '''
      submitted TEXT,
      completed TEXT,
      priority INTEGER,
-     status INTEGER)
+     status INTEGER,
+     jobs_hash TEXT,
+     state BLOB,
+     summary TEXT,
+     user TEXT)
+'''
+
+CREATE_OUTPUTS_TABLE_QUERY = '''
+    CREATE TABLE IF NOT EXISTS outputs
+    (key TEXT PRIMARY KEY,
+     workflow INTEGER,
+     size INTEGER,
+     data BLOB)
+'''
+
+#: Workflows referencing each stored output, as the output of a task is
+#: shared by every workflow waiting on the task
+CREATE_OUTPUT_REFS_TABLE_QUERY = '''
+    CREATE TABLE IF NOT EXISTS output_refs
+    (key TEXT,
+     workflow INTEGER,
+     PRIMARY KEY (key, workflow))
+'''
+
+CREATE_INDEX_QUERIES = [
+    'CREATE INDEX IF NOT EXISTS workflows_jobs_hash ON workflows (jobs_hash)',
+    'CREATE INDEX IF NOT EXISTS workflows_status ON workflows (status)',
+    'CREATE INDEX IF NOT EXISTS outputs_workflow ON outputs (workflow)',
+    'CREATE INDEX IF NOT EXISTS output_refs_workflow ON output_refs (workflow)',
+]
+
+#: Pragmas applied to each connection for the storage modes
+STORAGE_PRAGMAS = {
+    'default': [],
+    'wal': [
+        'PRAGMA journal_mode=WAL',
+        'PRAGMA synchronous=NORMAL',
+        'PRAGMA cache_size=-16384',
+        'PRAGMA temp_store=MEMORY',
+    ],
+}
+
+UPDATE_STATUS_QUERY = '''
+    UPDATE workflows
+    SET status=?, completed=? WHERE id=?
+'''
+
+INSERT_OUTPUT_QUERY = '''
+    INSERT INTO outputs(key, workflow, size, data)
+    VALUES (?, ?, ?, ?)
+'''
+
+INSERT_OUTPUT_REF_QUERY = '''
+    INSERT INTO output_refs(key, workflow)
+    VALUES (?, ?)
 '''
 
+#: Columns returned when a workflow is fetched
+WORKFLOW_COLUMNS = ('id, name, log, jobs, submitted, completed, priority, status, '
+                    'user')
+
 START_INDEX_QUERY = '''
     UPDATE SQLITE_SEQUENCE
     SET seq=?
@@ -25,36 +95,115 @@ START_INDEX_QUERY = '''
 
 encoder = JSONEncoder()
 
+#: Encodes jobs the same way regardless of the order of their keys
+canonical_encoder = JSONEncoder(sort_keys=True, separators=(',', ':'))
+
+def timestamp():
+    """
+    Returns the current time in the form it is read back from the database
+
+    Times are kept in TEXT columns, so they are written as text to read the
+    same whether or not they have been flushed.
+    """
+    return unicode(repr(time()))
+
+def jobs_hash(jobs):
+    """
+    Returns the hash of the canonical encoding of the jobs
+    """
+    return sha1(canonical_encoder.encode(jobs)).hexdigest()
+
 class Database(object):
     """
     A minimal interface that abstract the sqlite api
+
+    Each thread is given its own connection to the database.
     """
 
     def __init__(self):
-        self.handle = None
+        self.filename = None
+        self.pragmas = []
+        self.local = local()
 
-    def connect(self, filename):
+    def connect(self, filename, storage='default'):
         """
         Returns a connection to the database
+
+        The storage mode selects the pragmas applied to each connection.
         """
-        self.handle = connect(filename)
+        self.filename = filename
+        self.pragmas = STORAGE_PRAGMAS[storage]
+        self.local.handle = self._open()
+
+    def _open(self):
+        """
+        Opens a new connection with the pragmas of the storage mode
+        """
+        handle = connect(self.filename)
+
+        for pragma in self.pragmas:
+            handle.execute(pragma)
+
+        return handle
+
+    @property
+    def handle(self):
+        """
+        Returns the connection of the current thread
+        """
+        handle = getattr(self.local, 'handle', None)
+
+        if handle is None:
+            handle = self._open()
+            self.local.handle = handle
+
+        return handle
+
+    @contextmanager
+    def transaction(self):
+        """
+        Commits the statements executed within the block together
+        """
+        if getattr(self.local, 'transaction', False):
+            yield
+            return
+
+        self.local.transaction = True
+
+        try:
+            with self.handle:
+                yield
+        finally:
+            self.local.transaction = False
 
     def execute(self, query, params=()):
         """
         Executes a query on the database
         """
         try:
-            with self.handle:
+            with self.transaction():
                 cursor = self.handle.execute(query, params)
             return cursor
         except IntegrityError:
             pass
 
+    def executemany(self, query, params):
+        """
+        Executes a query for each set of parameters in one transaction
+        """
+        try:
+            with self.transaction():
+                cursor = self.handle.executemany(query, params)
+            return cursor
+        except IntegrityError:
+            pass
+
     def close(self):
         """
         Closes the connect to the database
         """
         self.handle.close()
+        self.local.handle = None
 
 
 def setup(filename, start_index=0):
@@ -63,17 +212,265 @@ def setup(filename, start_index=0):
     """
     database = connect(filename)
     database.execute(CREATE_TABLE_QUERY)
+    migrate(database)
     database.execute(START_INDEX_QUERY, (start_index,))
+    database.commit()
     database.close()
 
+def migrate(handle):
+    """
+    Upgrades the workflow table of an existing database
+
+    The jobs hash column is added and filled in for the workflows that were
+    stored before it existed. The columns holding the final state of the jobs
+    and their summary and of the user the workflow is shared with and the
+    tables of job outputs are created, with the
+    outputs stored before they could be shared referenced by their workflow.
+    """
+    columns = [row[1] for row in handle.execute('PRAGMA table_info(workflows)')]
+    tables = [row[0] for row in handle.execute(
+        "SELECT name FROM sqlite_master WHERE type='table'")]
+
+    with handle:
+        if 'jobs_hash' not in columns:
+            handle.execute('ALTER TABLE workflows ADD COLUMN jobs_hash TEXT')
+
+        if 'state' not in columns:
+            handle.execute('ALTER TABLE workflows ADD COLUMN state BLOB')
+
+        if 'summary' not in columns:
+            handle.execute('ALTER TABLE workflows ADD COLUMN summary TEXT')
+
+        if 'user' not in columns:
+            handle.execute('ALTER TABLE workflows ADD COLUMN user TEXT')
+
+        handle.execute(CREATE_OUTPUTS_TABLE_QUERY)
+        handle.execute(CREATE_OUTPUT_REFS_TABLE_QUERY)
+
+        if 'outputs' in tables and 'output_refs' not in tables:
+            handle.execute('''
+                INSERT INTO output_refs(key, workflow)
+                SELECT key, workflow FROM outputs
+            ''')
+
+        for query in CREATE_INDEX_QUERIES:
+            handle.execute(query)
+
+    #: Hashes are filled in by batches of workflows in order of their id so
+    #: that only a batch of jobs is held in memory at once
+    last = 0
+
+    while True:
+        rows = handle.execute('''
+            SELECT id, jobs FROM workflows
+            WHERE jobs_hash IS NULL AND jobs IS NOT NULL AND id>?
+            ORDER BY id LIMIT ?
+        ''', (last, MIGRATE_BATCH_SIZE)).fetchall()
+
+        if not rows:
+            break
+
+        hashes = [(jobs_hash(loads(jobs)), workflow_id)
+                  for (workflow_id, jobs) in rows]
+
+        with handle:
+            handle.executemany('''
+                UPDATE workflows
+                SET jobs_hash=? WHERE id=?
+            ''', hashes)
+
+        last = rows[-1][0]
+
 class WorkflowStore(object):
-    def __init__(self, database):
+    def __init__(self, database, flush_interval=0):
         self.database = database
 
+        #: Status updates are written every flush_interval milliseconds
+        #: when it is set, otherwise they are written immediately
+        self.flush_interval = flush_interval / 1000.0
+        self.flushed = time()
+        self.pending = {}
+        self.pending_outputs = {}
+        self.lock = Lock()
+
+    def _pending(self, workflow_id):
+        """
+        Returns the status update that has not been written yet
+        """
+        with self.lock:
+            return self.pending.get(workflow_id)
+
+    def _merge(self, row, completed_index, status_index):
+        """
+        Returns the row with the pending status update applied
+        """
+        params = self._pending(row[0])
+
+        if params is None:
+            return row
+
+        row = list(row)
+        (row[status_index], row[completed_index], _) = params
+        return tuple(row)
+
+    def due(self):
+        """
+        Returns whether the pending status updates should be written
+        """
+        return ((self.pending or self.pending_outputs) and
+                time() - self.flushed >= self.flush_interval)
+
+    def flush(self):
+        """
+        Writes the pending status updates and outputs in a single
+        transaction
+
+        Returns the number of rows written.
+        """
+        with self.lock:
+            pending = self.pending.values()
+            outputs = self.pending_outputs.values()
+
+            with self.database.transaction():
+                if outputs:
+                    self._insert_outputs(outputs)
+                    self.pending_outputs = {}
+
+                if pending:
+                    self.database.executemany(UPDATE_STATUS_QUERY, pending)
+                    self.pending = {}
+
+            self.flushed = time()
+
+        return len(pending) + len(outputs)
+
+    def add_output(self, workflow_ids, output):
+        """
+        Stores the compressed output of a task once for the workflows waiting
+        on it and returns its key
+        """
+        key = uuid4().hex
+        params = (key, workflow_ids[0], len(output),
+                  Binary(zlib.compress(output)))
+
+        if self.flush_interval:
+            with self.lock:
+                self.pending_outputs[key] = (params, list(workflow_ids))
+        else:
+            self._insert_outputs([(params, workflow_ids)])
+
+        return key
+
+    def _insert_outputs(self, outputs):
+        """
+        Inserts the outputs along with the workflows referencing them
+        """
+        refs = [(params[0], workflow_id) for (params, workflow_ids) in outputs
+                for workflow_id in workflow_ids]
+
+        with self.database.transaction():
+            self.database.executemany(INSERT_OUTPUT_QUERY,
+                [params for (params, _) in outputs])
+            self.database.executemany(INSERT_OUTPUT_REF_QUERY, refs)
+
+    def get_output(self, key):
+        """
+        Returns the output of a job or None if it was not found
+        """
+        with self.lock:
+            pending = self.pending_outputs.get(key)
+
+        if pending:
+            return zlib.decompress(pending[0][3])
+
+        query = '''
+            SELECT data FROM outputs
+            WHERE key=?
+        '''
+
+        row = self.database.execute(query, (key,)).fetchone()
+
+        if row:
+            return zlib.decompress(row[0])
+
+        return None
+
+    def save_states(self, states):
+        """
+        Stores the final state of the jobs of each workflow
+
+        The states are given as pairs of the jobs, which are compressed, and
+        the number of jobs in each state.
+        """
+        query = '''
+            UPDATE workflows
+            SET state=?, summary=? WHERE id=?
+        '''
+
+        params = ((Binary(zlib.compress(encoder.encode(jobs))),
+                   encoder.encode(summary), workflow_id)
+                  for (workflow_id, (jobs, summary)) in states.items())
+
+        self.database.executemany(query, params)
+
+    def get_state(self, workflow_id):
+        """
+        Returns the stored jobs of the workflow and their summary
+        """
+        query = '''
+            SELECT state, summary FROM workflows
+            WHERE id=?
+        '''
+
+        row = self.database.execute(query, (workflow_id,)).fetchone()
+
+        if row and row[0]:
+            return (loads(zlib.decompress(row[0])), loads(row[1] or '{}'))
+
+        return None
+
+    def remove_outputs(self, workflow_id):
+        """
+        Removes the references of the workflow to the stored job outputs
+
+        The outputs no other workflow references are removed.
+        """
+        with self.lock:
+            for (key, (_, workflow_ids)) in self.pending_outputs.items():
+                if workflow_id in workflow_ids:
+                    workflow_ids.remove(workflow_id)
+
+                if not workflow_ids:
+                    del self.pending_outputs[key]
+
+        with self.database.transaction():
+            cursor = self.database.execute('''
+                SELECT key FROM output_refs
+                WHERE workflow=?
+            ''', (workflow_id,))
+
+            keys = [(key, key) for (key,) in cursor.fetchall()]
+
+            self.database.execute('''
+                DELETE FROM output_refs
+                WHERE workflow=?
+            ''', (workflow_id,))
+
+            self.database.executemany('''
+                DELETE FROM outputs
+                WHERE key=? AND NOT EXISTS
+                    (SELECT 1 FROM output_refs WHERE key=?)
+            ''', keys)
+
     def get_status(self, workflow_id):
         """
         Returns the status of the workflow
         """
+        params = self._pending(workflow_id)
+
+        if params:
+            return params[0]
+
         query = '''
             SELECT status FROM workflows
             WHERE id=?
@@ -90,32 +487,46 @@ class WorkflowStore(object):
     def find_workflow(self, jobs):
         """
         Finds the workflow and returns its id
+
+        Workflows are found by the hash of their jobs and the jobs are only
+        compared when more than one workflow has the same hash.
         """
         query = '''
-            SELECT * FROM workflows
-            WHERE jobs=?
-        '''
-        jobs_json = encoder.encode(jobs)
-        cursor = self.database.execute(query, (jobs_json,))
-        return cursor.fetchone()
+            SELECT {columns} FROM workflows
+            WHERE jobs_hash=?
+        '''.format(columns=WORKFLOW_COLUMNS)
+        cursor = self.database.execute(query, (jobs_hash(jobs),))
+        rows = [self._merge(row, 5, 7) for row in cursor.fetchall()]
+
+        if len(rows) == 1:
+            return rows[0]
+
+        for row in rows:
+            if loads(row[3]) == jobs:
+                return row
+
+        return None
 
     def add_workflow(self, name=None, log=None, jobs=None,
-                    priority=0, status=Status.Initialized):
+                    priority=0, status=Status.Initialized, user=None):
         """
         Adds the workflow and returns its id
         """
         query = '''
             INSERT INTO workflows(name, log, jobs, submitted, completed,
-                                status, priority)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
+                                status, priority, jobs_hash, user)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
         '''
 
         if jobs:
             job_json = encoder.encode(jobs)
+            job_hash = jobs_hash(jobs)
         else:
             job_json = None
+            job_hash = None
 
-        params = (name, log, job_json, time(), None, status, priority)
+        params = (name, log, job_json, timestamp(), None, status, priority,
+                  job_hash, user)
 
         cursor = self.database.execute(query, params)
         return cursor.lastrowid
@@ -126,47 +537,63 @@ class WorkflowStore(object):
         """
 
         query = """
-            SELECT *
+            SELECT {columns}
             FROM workflows
             WHERE id=?
-        """
+        """.format(columns=WORKFLOW_COLUMNS)
         cursor = self.database.execute(query, (workflow_id,))
-        return cursor.fetchone()
+        row = cursor.fetchone()
+
+        if row:
+            return self._merge(row, 5, 7)
+
+        return row
 
     def update_workflow(self, workflow_id, name=None, log=None, jobs=None,
-                        priority=0):
+                        priority=0, user=None):
         """
         Persists the pickled workflow into the database
         """
         query = """
             UPDATE workflows
-            SET name=?, log=?, jobs=?, priority=?
+            SET name=?, log=?, jobs=?, priority=?, jobs_hash=?, user=?
             WHERE id=?
         """
         if jobs:
             job_json = encoder.encode(jobs)
+            job_hash = jobs_hash(jobs)
         else:
             job_json = None
+            job_hash = None
 
-        params = (name, log, job_json, priority, workflow_id)
+        params = (name, log, job_json, priority, job_hash, user, workflow_id)
         self.database.execute(query, params)
 
-    def update_status(self, workflow_id, status, completed=False):
+    def update_user(self, workflow_id, user):
         """
-        Updates the status of the workflow
+        Updates the user the workflow is shared with
         """
-
         query = '''
             UPDATE workflows
-            SET status=?, completed=? WHERE id=?
+            SET user=? WHERE id=?
         '''
 
+        self.database.execute(query, (user, workflow_id))
+
+    def update_status(self, workflow_id, status, completed=False):
+        """
+        Updates the status of the workflow
+        """
         if completed:
-            params = (status, time(), workflow_id)
+            params = (status, timestamp(), workflow_id)
         else:
             params = (status, None, workflow_id)
 
-        self.database.execute(query, params)
+        if self.flush_interval:
+            with self.lock:
+                self.pending[workflow_id] = params
+        else:
+            self.database.execute(UPDATE_STATUS_QUERY, params)
 
     def restart_workflow(self, workflow_id):
         """
@@ -178,7 +605,7 @@ class WorkflowStore(object):
             SET submitted=? WHERE id=?
         '''
 
-        params = (time(), workflow_id)
+        params = (timestamp(), workflow_id)
         self.database.execute(query, params)
 
     def stop_workflows(self):
@@ -192,36 +619,116 @@ class WorkflowStore(object):
             WHERE status=?
         '''
 
-        params = (Status.Stopped, time(), Status.Running)
+        params = (Status.Stopped, timestamp(), Status.Running)
         self.database.execute(query, params)
 
-    def fetch(self, ids=None, status=None):
+    def running_workflows(self):
+        """
+        Returns the ids of the Running workflows by priority then age
         """
-        Returns a subset of workflows
 
-        If ids is specified the workflows will be limited to the subset of
-        of workflows with matching ids.
+        query = '''
+            SELECT id FROM workflows
+            WHERE status=?
+            ORDER BY priority DESC, id
+        '''
+
+        cursor = self.database.execute(query, (Status.Running,))
+        return [workflow_id for (workflow_id,) in cursor.fetchall()]
+
+    def fetch(self, ids=None, status=None, cursor=None, limit=None,
+              submitted=None, completed=None, name=None, priority=None):
         """
+        Returns an iterator over a subset of workflows
+
+        If ids is specified the workflows will be limited to the subset of
+        of workflows with matching ids. The submitted and completed filters
+        are (start, end) pairs of times where either end may be None.
 
+        When a limit is given the workflows are returned newest first
+        starting below the cursor so that they can be paged through.
+        """
         query = '''
-                SELECT id, name, submitted, completed, status, priority
+                SELECT id, name, submitted, completed, status, priority,
+                       summary
                 FROM workflows
             '''
+        clauses = []
+        params = []
 
-        if ids and status:
-            query += ' WHERE id IN ({ids}) AND status={status}'
-            id_string = ",".join(set(str(workflow_id) for workflow_id in ids))
-            status = status_code(status)
-            cursor = self.database.execute(query.format(ids=id_string, status=status))
-        elif ids:
-            query += ' WHERE id IN ({ids})'   
-            id_string = ",".join(set(str(workflow_id) for workflow_id in ids))
-            cursor = self.database.execute(query.format(ids=id_string))
-        elif status:
-            query += ' WHERE status=?'
-            status = status_code(status)
-            cursor = self.database.execute(query, (status,))
-        else:
-            cursor = self.database.execute(query)
+        if ids:
+            ids = set(int(workflow_id) for workflow_id in ids)
+            clauses.append('id IN ({})'.format(', '.join('?' * len(ids))))
+            params.extend(ids)
+
+        if status:
+            clauses.append('status=?')
+            params.append(status_code(status))
+
+        if cursor is not None:
+            clauses.append('id<?')
+            params.append(int(cursor))
+
+        for (column, bounds) in (('submitted', submitted),
+                                 ('completed', completed)):
+            (start, end) = bounds or (None, None)
+
+            if start is not None:
+                clauses.append('CAST({} AS REAL)>=?'.format(column))
+                params.append(float(start))
+
+            if end is not None:
+                clauses.append('CAST({} AS REAL)<?'.format(column))
+                params.append(float(end))
+
+        if name:
+            clauses.append('substr(name, 1, ?)=?')
+            params.extend((len(name), name))
+
+        if priority is not None:
+            clauses.append('priority=?')
+            params.append(int(priority))
+
+        if clauses:
+            query += ' WHERE ' + ' AND '.join(clauses)
+
+        if limit is not None:
+            query += ' ORDER BY id DESC LIMIT ?'
+            params.append(int(limit))
+
+        return self._iterate(self.database.execute(query, params))
+
+    def _iterate(self, cursor, size=500):
+        """
+        Yields the rows of the cursor with pending status updates applied
+        """
+        while True:
+            rows = cursor.fetchmany(size)
+
+            if not rows:
+                return
+
+            for row in rows:
+                yield self._merge(row, 3, 4)
+
+class StoreService(Service):
+    """
+    Writes the pending status updates of the store periodically
+    """
+    name = "store"
+    group = "database"
+
+    def __init__(self, store):
+        self.store = store
+
+    def update(self):
+        '''Writes the pending status updates when they are due'''
+        if self.store.due():
+            return self.store.flush()
+
+        return 0
 
-        return cursor.fetchall()
+    def stop(self):
+        '''Writes any pending status updates'''
+        updated = self.store.flush()
+        logger.info("DATABASE: wrote %s pending status updates", updated)
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+from logging import getLogger
+import json
+
+import zmq
+
+from yerba.core import status_name
+from yerba.services import Service
+
+logger = getLogger('yerba.events')
+
+def topic(workflow_id):
+    '''Returns the topic the changes of the workflow are published on'''
+    return "workflow.{}.".format(workflow_id)
+
+class Publisher(Service):
+    """
+    Publishes the changes made to workflows on a PUB socket
+
+    Each message is sent on the topic of its workflow and carries a sequence
+    number shared by all messages along with the versions of the workflow it
+    spans, so that subscribers can detect the messages they missed.
+    """
+    name = "publisher"
+    group = "events"
+
+    def __init__(self, port):
+        self.port = port
+        self.socket = None
+
+        #: Number of the last message published
+        self.sequence = 0
+
+    def initialize(self):
+        '''Binds the PUB socket'''
+        self.socket = zmq.Context.instance().socket(zmq.PUB)
+        self.socket.set(zmq.LINGER, 0)
+        self.socket.bind("tcp://*:{}".format(self.port))
+
+    def publish(self, workflow_id, workflow, since=None):
+        '''
+        Publishes the jobs of the workflow changed after the version
+
+        Every job is published when since is None.
+        '''
+        self.sequence += 1
+
+        message = {
+            "sequence": self.sequence,
+            "id": workflow_id,
+            "status": status_name(workflow.status),
+            "summary": workflow.summary(),
+            "since": since,
+            "version": workflow.version,
+        }
+
+        if since is None:
+            message["jobs"] = workflow.state()
+        else:
+            message["changes"] = {index: workflow.jobs[index].state
+                                  for index in workflow.changes(since)}
+
+        try:
+            self.socket.send_multipart([topic(workflow_id),
+                                        json.dumps(message)],
+                                       flags=zmq.NOBLOCK)
+        except zmq.ZMQError:
+            logger.exception("EVENTS: Failed to publish workflow %s",
+                             workflow_id)
+
+    def update(self):
+        '''Messages are published as changes are made'''
+        return 0
+
+    def stop(self):
+        '''Closes the PUB socket'''
+        if self.socket:
+            self.socket.close()
+            self.socket = None
@@ -1,17 +1,25 @@
 # -*- coding: utf-8 -*-
+from collections import OrderedDict
 from datetime import datetime
+from heapq import heappush, heappop
 from logging import getLogger
 from os import getloadavg
+from threading import RLock
 from time import time, sleep
 import json
 
-from yerba.core import Status, status_name, SCHEDULE_TASK, CANCEL_TASK
-from yerba.db import Database, WorkflowStore
+from yerba.core import (Status, status_name, DONE_STATUS, SCHEDULE_TASK,
+                        CANCEL_TASK, WORKFLOW_CHANGED)
+from yerba.db import Database, WorkflowStore, migrate
+from yerba.services import Service
 from yerba.workflow import WorkflowError, Workflow
 from yerba.utils import ignored, meminfo
 
 logger = getLogger('yerba.manager')
 
+#: Number of characters at the end of a job output kept in its info
+OUTPUT_TAIL = 1024
+
 class ServiceManager(object):
     core = {}
     RUNNING = False
@@ -67,13 +75,24 @@ class ServiceManager(object):
 
     @classmethod
     def update(cls):
-        '''Run service update callback.'''
+        '''
+        Run service update callback.
+
+        Returns the number of events the services handled.
+        '''
+        handled = 0
+
         for service in cls.core.values():
-            service.update()
+            handled += service.update() or 0
+
+        return handled
 
     @classmethod
     def stop(cls):
         '''Stops the service manager and all core'''
+        if not cls.RUNNING:
+            return
+
         for service in cls.core.values():
             service.stop()
 
@@ -165,16 +184,76 @@ class WorkflowManager(object):
     workflows = {}
     notifier = None
 
+    #: Held while workflows are modified so that read-only requests served
+    #: from other threads see a consistent snapshot
+    lock = RLock()
+
+    #: Finished workflows in memory ordered by when they were last used
+    #: along with their number of jobs
+    finished = OrderedDict()
+    finished_jobs = 0
+
+    #: Finished workflows are evicted after evict_after seconds or when
+    #: more workflows or jobs than the limits are kept in memory
+    evict_after = 3600
+    max_finished = 1000
+    max_finished_jobs = 200000
+
+    #: Heap of the workflows with jobs waiting to be retried by when the
+    #: first of them is due, where only the entry matching the due time of
+    #: the workflow is current
+    retrying = []
+    retry_due = {}
+
+    #: Workflows left Running by the last daemon that are waiting to be
+    #: resumed and the most resumed in a single update
+    recovering = OrderedDict()
+    recovery_batch = 100
+
     @classmethod
     def set_notifier(cls, notifier):
         '''Sets the notifier object'''
         cls.notifier = notifier
 
     @classmethod
-    def connect(cls, filename):
-        '''Connect to workflow database'''
-        cls.database.connect(filename)
-        cls.store = WorkflowStore(cls.database)
+    def connect(cls, filename, storage='default', flush_interval=0):
+        '''
+        Connect to workflow database
+
+        When flush_interval is set status updates are written to the
+        database in batches every flush_interval milliseconds.
+        '''
+        cls.database.connect(filename, storage=storage)
+        migrate(cls.database.handle)
+        cls.store = WorkflowStore(cls.database, flush_interval=flush_interval)
+
+    @classmethod
+    def set_eviction(cls, evict_after=None, max_finished=None,
+                     max_finished_jobs=None):
+        '''Sets the limits on the finished workflows kept in memory'''
+        if evict_after is not None:
+            cls.evict_after = evict_after
+
+        if max_finished is not None:
+            cls.max_finished = max_finished
+
+        if max_finished_jobs is not None:
+            cls.max_finished_jobs = max_finished_jobs
+
+    @classmethod
+    def set_retries(cls, delay=None, max_delay=None):
+        '''Sets the delays before the jobs of workflows are retried'''
+        if delay is not None:
+            Workflow.retry_delay = delay
+
+        if max_delay is not None:
+            Workflow.max_retry_delay = max_delay
+
+    @classmethod
+    def set_recovery(cls, batch=None):
+        '''Sets the most workflows resumed in a single update'''
+        if batch is not None:
+            cls.recovery_batch = batch
 
     @classmethod
     def create(cls, workflow=None, jobs_object=None, status=Status.Initialized):
@@ -183,7 +262,7 @@ class WorkflowManager(object):
         if workflow and jobs_object:
             workflow_id = cls.store.add_workflow(
                 name=workflow.name, log=workflow.log, jobs=jobs_object,
-                status=status, priority=workflow.priority)
+                status=status, priority=workflow.priority, user=workflow.user)
         else:
             workflow_id = cls.store.add_workflow(status=status)
 
@@ -193,17 +272,57 @@ class WorkflowManager(object):
     @classmethod
     def submit(cls, data):
         '''Generate and schedule the workflow to be run'''
-        workflow_id = data.get('id', None)
+        (workflow, errors) = cls._generate(data)
+
+        if workflow is None:
+            return (None, Status.Error, errors)
+
+        return cls._submit(data, workflow)
+
+    @classmethod
+    def submit_batch(cls, batch):
+        '''
+        Generates and schedules each of the workflows
+
+        Every workflow is generated before any is stored and the workflows
+        are stored in a single transaction. Returns the id, status and errors
+        of each workflow.
+        '''
+        generated = [cls._generate(data) for data in batch]
+        results = []
+
+        with cls.database.transaction():
+            for (data, (workflow, errors)) in zip(batch, generated):
+                if workflow is None:
+                    results.append((None, Status.Error, errors))
+                    continue
+
+                try:
+                    results.append(cls._submit(data, workflow))
+                except Exception:
+                    logger.exception("the workflow %s failed to be submitted",
+                                     workflow.name)
+                    results.append((None, Status.Error, None))
+
+        return results
 
+    @classmethod
+    def _generate(cls, data):
+        '''Returns the workflow generated from the data and its errors'''
         try:
-            workflow = Workflow.from_object(data)
+            return (Workflow.from_object(data), None)
         except WorkflowError as e:
             logger.exception("the workflow failed to be generated")
-            return (None, Status.Error, e.errors)
+            return (None, e.errors)
         except Exception as e:
             logger.exception("""an unexpected error occured during
                             workflow generation""")
-            return (None, Status.Error, None)
+            return (None, None)
+
+    @classmethod
+    def _submit(cls, data, workflow):
+        '''Stores and schedules the generated workflow'''
+        workflow_id = data.get('id', None)
 
         # Check if the id was given otherwise try to find the workflow
         # Create a new entry if the workflow was not found
@@ -214,7 +333,7 @@ class WorkflowManager(object):
             workflow_found = cls.store.find_workflow(data['jobs'])
 
         if workflow_found:
-            (workflow_id, _, _, _, _, _, _, status) = workflow_found
+            (workflow_id, _, _, _, _, _, _, status, user) = workflow_found
 
             if workflow_id in cls.workflows and status == Status.Running:
                 logger.info("workflow id=%s is already runnning", workflow_id)
@@ -224,126 +343,465 @@ class WorkflowManager(object):
                 logger.info("updating workflow id=%s", workflow_id)
                 cls.store.update_workflow(workflow_id,
                     name=workflow.name, log=workflow.log, jobs=data['jobs'],
-                    priority=workflow.priority)
+                    priority=workflow.priority, user=workflow.user)
+            elif user != workflow.user:
+                cls.store.update_user(workflow_id, workflow.user)
         else:
 
             (workflow_id, _) = cls.create(workflow=workflow,
                                           jobs_object=data['jobs'])
 
-        cls.workflows[workflow_id] = workflow
+        cls._add(workflow_id, workflow)
+        cls.store.remove_outputs(workflow_id)
         scheduled_status = cls.schedule(workflow_id, workflow)
 
         return (workflow_id, scheduled_status, None)
 
     @classmethod
-    def schedule(cls, workflow_id, workflow):
-        '''Schedules a workflow by its id'''
-
-        jobs = workflow.next()
-        cls.store.update_status(workflow_id, workflow.status)
+    def schedule(cls, workflow_id, workflow, since=None):
+        '''
+        Schedules a workflow by its id
+
+        The changes made after the version since are published, or every
+        job when since is None.
+        '''
+
+        with cls.lock:
+            jobs = workflow.next()
+            cls.store.update_status(workflow_id, workflow.status)
+            cls._finish(workflow_id, workflow)
+            cls._wait(workflow_id, workflow)
+            cls.notifier.notify(WORKFLOW_CHANGED, workflow_id, workflow,
+                                since=since)
 
         #: Submit any jobs to the queue
         if jobs:
             cls.notifier.notify(SCHEDULE_TASK, jobs, workflow_id,
-                                priority=workflow.priority)
+                                priority=workflow.priority,
+                                user=workflow.user)
             logger.info("submitted workflow id=%s", workflow_id)
 
         return workflow.status
 
     @classmethod
-    def get_workflows(cls, ids, status):
+    def get_workflows(cls, ids=None, status=None, **filters):
         '''Returns all matching workflows in the job engine'''
-        return cls.store.fetch(ids, status)
+        return cls.store.fetch(ids=ids, status=status, **filters)
 
     @classmethod
-    def update(cls, workflow_id, job, info):
-        '''Updates the job with details'''
+    def complete(cls, results):
+        '''
+        Updates the workflows with the jobs completed in a batch of tasks
+
+        The results are the completed jobs and their details by workflow.
+        The output of each task is stored once for every workflow waiting on
+        it and the batch is written in a single transaction.
+        '''
+        tasks = OrderedDict()
+
+        with cls.lock:
+            for (workflow_id, jobs) in results.items():
+                if workflow_id not in cls.workflows:
+                    continue
+
+                for (_, info) in jobs:
+                    (_, workflow_ids) = tasks.setdefault(info['taskid'],
+                                                         (info, []))
+                    workflow_ids.append(workflow_id)
+
+        with cls.database.transaction():
+            stored = {taskid: cls._store_output(workflow_ids, info)
+                      for (taskid, (info, workflow_ids)) in tasks.items()}
+
+            for (workflow_id, jobs) in results.items():
+                cls.update(workflow_id, [(job, stored[info['taskid']])
+                                         for (job, info) in jobs
+                                         if info['taskid'] in stored])
 
-        with ignored(KeyError):
+    @classmethod
+    def update(cls, workflow_id, results):
+        '''
+        Updates the workflow with each completed job along with its stored
+        details and output
+        '''
+
+        with cls.lock, ignored(KeyError):
             workflow = cls.workflows[workflow_id]
+            since = workflow.version
 
             #: Update the status of the workflow
-            workflow.update_status(job, info)
+            for (job, (info, output)) in results:
+                workflow.update_status(job, info, output=output)
 
             #: Fetch next set of tasks and update the worflow
             iterable = workflow.next()
 
-            logger.info("updating workflow id=%s status=%s",
-                        workflow.name, status_name(workflow.status))
+            logger.info("updating workflow id=%s status=%s jobs=%s",
+                        workflow.name, status_name(workflow.status),
+                        len(results))
 
             #: Save the status to the store and submit tasks
             if workflow.status != Status.Running:
                 cls.store.update_status(workflow_id, workflow.status,
                                  completed=True)
+                cls._finish(workflow_id, workflow)
             else:
                 cls.notifier.notify(SCHEDULE_TASK, iterable, workflow_id,
-                                    priority=workflow.priority)
+                                    priority=workflow.priority,
+                                    user=workflow.user)
                 cls.store.update_status(workflow_id, workflow.status)
 
+            cls._wait(workflow_id, workflow)
+            cls.notifier.notify(WORKFLOW_CHANGED, workflow_id, workflow,
+                                since=since)
+
     @classmethod
-    def status(cls, workflow_id):
-        '''Gets the status of the current workflow.'''
-        status = cls.store.get_status(workflow_id)
-        jobs = []
+    def retry(cls):
+        '''
+        Schedules the workflows with jobs that are due to be retried
 
-        with ignored(KeyError):
-            workflow = cls.workflows[int(workflow_id)]
-            jobs = workflow.state()
+        Returns the number of workflows scheduled.
+        '''
+        now = time()
+        due = []
+
+        with cls.lock:
+            while cls.retrying and cls.retrying[0][0] <= now:
+                (when, workflow_id) = heappop(cls.retrying)
+
+                if cls.retry_due.get(workflow_id) != when:
+                    continue
+
+                del cls.retry_due[workflow_id]
+                workflow = cls.workflows.get(workflow_id)
+
+                if workflow and workflow.status == Status.Running:
+                    due.append((workflow_id, workflow))
+
+        for (workflow_id, workflow) in due:
+            cls.schedule(workflow_id, workflow, since=workflow.version)
+
+        return len(due)
+
+    @classmethod
+    def _wait(cls, workflow_id, workflow):
+        '''Tracks when the next job of the workflow is due to be retried'''
+        if not workflow.retrying:
+            cls.retry_due.pop(workflow_id, None)
+            return
+
+        when = workflow.retrying[0][0]
+
+        if cls.retry_due.get(workflow_id) != when:
+            cls.retry_due[workflow_id] = when
+            heappush(cls.retrying, (when, workflow_id))
+
+    @classmethod
+    def _store_output(cls, workflow_ids, info):
+        '''
+        Stores the output of a task for the workflows waiting on it and
+        returns the info and the output
+
+        The info returned only keeps the end of the output along with its
+        size and the key to fetch it from the store.
+        '''
+        info = dict(info)
+        output = info.pop('output', None) or ''
 
-        return (status, jobs)
+        if isinstance(output, unicode):
+            output = output.encode('utf-8')
+
+        info['output'] = output[-OUTPUT_TAIL:].decode('utf-8', 'replace')
+        info['output_size'] = len(output)
+        info['output_id'] = None
+
+        if output:
+            info['output_id'] = cls.store.add_output(workflow_ids, output)
+
+        return (info, output)
+
+    @classmethod
+    def summary(cls, workflow_id):
+        '''
+        Returns the number of jobs in each state of the workflow
+
+        None is returned when the workflow is not held in memory.
+        '''
+        with cls.lock, ignored(KeyError):
+            return cls.workflows[int(workflow_id)].summary()
+
+    @classmethod
+    def summaries(cls):
+        '''Returns the state and summary of each workflow in memory'''
+        with cls.lock:
+            return [{"id": workflow_id,
+                     "status": status_name(workflow.status),
+                     "version": workflow.version,
+                     "summary": workflow.summary()}
+                    for (workflow_id, workflow) in cls.workflows.items()]
+
+    @classmethod
+    def status(cls, workflow_id, output=False, jobs=True, since=None,
+               fields=None):
+        '''
+        Gets the status of the current workflow, its jobs, the number of
+        jobs in each state and the version of the workflow.
+
+        The jobs are left out when jobs is not set. When since is given only
+        the jobs changed after that version are returned by their index;
+        every job is returned when the version of the workflow is not known.
+        Each job only holds the given fields when fields are set. The full
+        output of each job is fetched from the store when output is set.
+        '''
+        workflow_id = int(workflow_id)
+        (states, version) = ([], None)
+
+        with cls.lock:
+            status = cls.store.get_status(workflow_id)
+
+            if workflow_id in cls.workflows:
+                workflow = cls.workflows[workflow_id]
+                (summary, version) = (workflow.summary(), workflow.version)
+
+                if jobs and since is None:
+                    states = list(enumerate(workflow.state()))
+                elif jobs:
+                    states = [(index, workflow.jobs[index].state)
+                              for index in workflow.changes(since)]
+
+                cls._touch(workflow_id)
+            else:
+                (stored, summary) = cls.store.get_state(workflow_id) or ([], {})
+                states = list(enumerate(stored)) if jobs else []
+
+        for (index, job) in states:
+            if output and job.get('output_id'):
+                text = cls.store.get_output(job['output_id']) or ''
+                job['output'] = text.decode('utf-8', 'replace')
+
+        if fields:
+            states = [(index, {field: job[field] for field in fields
+                               if field in job})
+                      for (index, job) in states]
+
+        if not jobs:
+            return (status, None, summary, version)
+
+        if since is None:
+            return (status, [job for (_, job) in states], summary, version)
+
+        return (status, dict(states), summary, version)
 
     @classmethod
     def cancel(cls, workflow_id):
         '''Cancel the workflow from being run.'''
         status = Status.NotFound
 
-        with ignored(KeyError):
+        with cls.lock:
+            if cls.recovering.pop(int(workflow_id), None):
+                cls.store.update_status(int(workflow_id), Status.Cancelled,
+                                        completed=True)
+                return Status.Cancelled
+
+        with cls.lock, ignored(KeyError):
             workflow = cls.workflows[int(workflow_id)]
             logger.info(('WORKQUEUE %s: the workflow has been requested'
             'to be cancelled'), workflow.name)
 
+            since = workflow.version
             workflow.cancel()
             status = workflow.status
 
             cls.store.update_status(int(workflow_id), status, completed=True)
-            cls.notifier.notify(CANCEL_TASK, int(workflow_id))
+            cls._finish(int(workflow_id), workflow)
+            cls.notifier.notify(WORKFLOW_CHANGED, int(workflow_id), workflow,
+                                since=since)
 
         return status
 
     @classmethod
     def restart(cls, workflow_id):
+        (wid, workflow, status) = cls._load(workflow_id)
+
+        if workflow is None:
+            return status
+
+        cls._add(wid, workflow)
+        cls.store.restart_workflow(workflow_id)
+        cls.store.remove_outputs(wid)
+        return cls.schedule(wid, workflow)
+
+    @classmethod
+    def _load(cls, workflow_id):
+        '''
+        Generates the workflow from its stored jobs
+
+        Returns the id, workflow and status of the workflow found, where the
+        workflow is None when it could not be generated.
+        '''
         workflow_found = cls.store.get_workflow(workflow_id)
 
         if not workflow_found:
-            return Status.NotFound
+            return (workflow_id, None, Status.NotFound)
 
-        (wid, name, log, jobs, _, _, priority, _) = workflow_found
+        (wid, name, log, jobs, _, _, priority, status, user) = workflow_found
 
         data = {
             "name": name,
             "priority": priority,
             "logfile": log,
+            "user": user,
             "jobs": json.loads(jobs)
         }
 
         try:
             workflow = Workflow.from_object(data)
-            logger.debug("restarting workflow name=%s", workflow.name)
+            logger.debug("loaded workflow name=%s", workflow.name)
         except WorkflowError as e:
             logger.exception("the workflow failed to be generated")
-            return Status.Error
+            return (wid, None, Status.Error)
         except Exception as e:
             logger.exception("""an unexpected error occured during
                             workflow generation""")
-            return Status.Error
+            return (wid, None, Status.Error)
 
-        cls.workflows[wid] = workflow
-        cls.store.restart_workflow(workflow_id)
-        return cls.schedule(wid, workflow)
+        return (wid, workflow, status)
 
     @classmethod
-    def cleanup(cls):
+    def recover(cls):
+        '''
+        Resumes the next batch of workflows left Running by the last daemon
+
+        Each workflow is generated again from its stored jobs so that jobs
+        whose outputs exist are skipped and the rest are scheduled. Returns
+        the number of workflows resumed.
+        '''
+        with cls.lock:
+            batch = []
+
+            while cls.recovering and len(batch) < cls.recovery_batch:
+                (workflow_id, _) = cls.recovering.popitem(last=False)
+                batch.append(workflow_id)
+
+        for workflow_id in batch:
+            (wid, workflow, status) = cls._load(workflow_id)
+
+            #: Workflows that can no longer be generated are stopped
+            if workflow is None:
+                if status != Status.NotFound:
+                    cls.store.update_status(workflow_id, Status.Stopped,
+                                            completed=True)
+                continue
+
+            #: Skip workflows that were changed while waiting to be resumed
+            if status != Status.Running or wid in cls.workflows:
+                continue
+
+            logger.info("resuming workflow id=%s", wid)
+            cls._add(wid, workflow)
+            cls.store.remove_outputs(wid)
+            cls.schedule(wid, workflow)
+
+        if batch and not cls.recovering:
+            logger.info("all running workflows have been resumed")
+
+        return len(batch)
+
+    @classmethod
+    def _add(cls, workflow_id, workflow):
+        '''Adds the workflow replacing any finished workflow'''
+        with cls.lock:
+            if workflow_id in cls.finished:
+                (_, jobs) = cls.finished.pop(workflow_id)
+                cls.finished_jobs -= jobs
+
+            cls.recovering.pop(workflow_id, None)
+            cls.workflows[workflow_id] = workflow
+
+    @classmethod
+    def _finish(cls, workflow_id, workflow):
+        '''
+        Tracks the workflow for eviction once it has finished
+
+        The queued jobs and the tasks of a workflow that did not complete are
+        dropped from work queue.
+        '''
+        if workflow.status in DONE_STATUS and workflow_id not in cls.finished:
+            cls.finished[workflow_id] = (time(), len(workflow.jobs))
+            cls.finished_jobs += len(workflow.jobs)
+
+            if workflow.status != Status.Completed:
+                cls.notifier.notify(CANCEL_TASK, workflow_id)
+
+    @classmethod
+    def _touch(cls, workflow_id):
+        '''Marks the finished workflow as recently used'''
+        if workflow_id in cls.finished:
+            (_, jobs) = cls.finished.pop(workflow_id)
+            cls.finished[workflow_id] = (time(), jobs)
+
+    @classmethod
+    def evict(cls):
+        '''
+        Moves finished workflows out of memory
+
+        The state of the jobs of each evicted workflow is saved to the store
+        so their status is served from the store. Returns the number of
+        workflows evicted.
+        '''
+        now = time()
+        states = {}
+
+        with cls.lock:
+            while cls.finished:
+                workflow_id = next(iter(cls.finished))
+                (used, jobs) = cls.finished[workflow_id]
+
+                if (now - used < cls.evict_after and
+                        len(cls.finished) <= cls.max_finished and
+                        cls.finished_jobs <= cls.max_finished_jobs):
+                    break
+
+                del cls.finished[workflow_id]
+                cls.finished_jobs -= jobs
+                workflow = cls.workflows.pop(workflow_id)
+                states[workflow_id] = (workflow.state(), workflow.summary())
+
+            if states:
+                cls.store.save_states(states)
+                logger.info("evicted %s finished workflows", len(states))
+
+        return len(states)
+
+    @classmethod
+    def cleanup(cls, recovery='stop'):
         """
         Go through all Running jobs and set there status to stopped.
+
+        When recovery is "resume" the Running workflows are instead queued
+        to be resumed in batches by the workflow service.
         """
-        cls.store.stop_workflows()
+        if recovery == 'resume':
+            with cls.lock:
+                for workflow_id in cls.store.running_workflows():
+                    cls.recovering[workflow_id] = True
+
+            logger.info("%s running workflows will be resumed",
+                        len(cls.recovering))
+        else:
+            cls.store.stop_workflows()
+
+class WorkflowService(Service):
+    """
+    Resumes, retries and evicts the workflows of the workflow manager
+    """
+    name = "workflows"
+    group = "manager"
+
+    def update(self):
+        '''
+        Resumes the workflows left running, retries the jobs that are due and
+        evicts the finished workflows that are past the limits
+        '''
+        return (WorkflowManager.recover() + WorkflowManager.retry() +
+                WorkflowManager.evict())
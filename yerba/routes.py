@@ -2,13 +2,32 @@
 from yerba import utils
 
 ROUTES = {}
+READONLY = set()
 
-def route(request):
-    '''Returns the request as a new endpoint.'''
+def route(request, readonly=False):
+    '''
+    Returns the request as a new endpoint.
+
+    Read-only endpoints do not modify any workflow and may be served
+    concurrently with the scheduler.
+    '''
     def callback(func):
         ROUTES[request] = func
+
+        if readonly:
+            READONLY.add(request)
+
+        return func
     return callback
 
+def is_readonly(request):
+    '''Returns whether the request is for a read-only route'''
+    if not isinstance(request, dict):
+        return False
+
+    endpoint = request.get('request')
+    return isinstance(endpoint, basestring) and endpoint in READONLY
+
 def dispatch(request):
     '''Dispatches request to given route'''
     with utils.ignored(KeyError):
@@ -18,5 +37,17 @@ def dispatch(request):
 
     raise RouteNotFound("The request could not be routed.")
 
+class Stream(object):
+    '''
+    A response sent as a multipart message.
+
+    Each part of the response is sent as a separate frame.
+    '''
+    def __init__(self, parts):
+        self.parts = parts
+
+    def __iter__(self):
+        return iter(self.parts)
+
 class RouteNotFound(utils.YerbaError):
     '''Exception raised when a dispatch route is not found.'''
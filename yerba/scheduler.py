@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+from collections import deque, Counter
+from heapq import heappush, heappop
+from itertools import count
+from logging import getLogger
+
+logger = getLogger('yerba.scheduler')
+
+def parse_shares(value):
+    '''
+    Returns the weight of each user from a string of user:weight pairs
+
+    The pairs are separated by commas, e.g. "alice:2, bob:1". A ValueError
+    is raised when a weight is not a positive number.
+    '''
+    shares = {}
+
+    for item in (value or '').split(','):
+        if not item.strip():
+            continue
+
+        (user, _, weight) = item.partition(':')
+        (user, weight) = (user.strip(), float(weight or 1))
+
+        if not weight > 0:
+            raise ValueError("The weight of {} must be positive".format(user))
+
+        shares[user] = weight
+
+    return shares
+
+def _priority(value):
+    '''Returns the priority as a number defaulting to 0'''
+    try:
+        return int(value or 0)
+    except (TypeError, ValueError):
+        return 0
+
+class Share(object):
+    '''The scheduling state of a workflow'''
+    __slots__ = ('jobs', 'priority', 'user', 'vtime', 'entry')
+
+    def __init__(self, priority, user, vtime):
+        self.jobs = deque()
+        self.priority = priority
+        self.user = user
+        self.vtime = vtime
+
+        #: Sequence number of the heap entry of the workflow
+        self.entry = None
+
+class FairScheduler(object):
+    """
+    Holds the ready jobs of each workflow until they are dispatched
+
+    Jobs are dispatched from the workflow with the highest priority. Between
+    workflows of the same priority the one with the lowest virtual time goes
+    first. The virtual time of a workflow advances each time one of its jobs
+    is dispatched by the number of active workflows of its user divided by
+    the weight of the user, so that users get a share of the tasks in
+    proportion to their weight however many workflows they submit.
+
+    A workflow with max_running tasks in flight is skipped until one of its
+    tasks finishes and it is woken up.
+    """
+
+    def __init__(self, running, max_running=0, shares=None):
+        #: Returns the number of tasks in flight of a workflow
+        self.running = running
+        self.max_running = max_running
+        self.shares = shares or {}
+
+        self.workflows = {}
+        self.heap = []
+        self.sequence = count()
+
+        #: Number of workflows with jobs queued for each user
+        self.users = Counter()
+
+        #: Virtual time of the last job dispatched
+        self.clock = 0.0
+
+        #: Number of jobs queued
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, name, jobs, priority=0, user=None):
+        '''Queues the jobs of the workflow'''
+        jobs = list(jobs)
+        share = self.workflows.get(name)
+
+        if not jobs:
+            return
+
+        if share is None:
+            share = Share(_priority(priority), user, self.clock)
+            self.workflows[name] = share
+            self.users[self._user(name, share)] += 1
+            logger.debug("SCHEDULER: queueing workflow %s of user %s with "
+                         "priority %s", name, user, share.priority)
+
+        share.jobs.extend(jobs)
+        self.size += len(jobs)
+
+        if share.entry is None:
+            self._push(name, share)
+
+    def remove(self, name):
+        '''Removes the queued jobs of the workflow'''
+        share = self.workflows.pop(name, None)
+
+        if share:
+            self._leave(self._user(name, share))
+            self.size -= len(share.jobs)
+            logger.debug("SCHEDULER: removed %s queued jobs of workflow %s",
+                         len(share.jobs), name)
+
+    def wake(self, name):
+        '''Queues the workflow again once one of its tasks has finished'''
+        share = self.workflows.get(name)
+
+        if share and share.jobs and share.entry is None:
+            self._push(name, share)
+
+    def pop(self):
+        '''
+        Returns the name, job and priority of the next job to dispatch
+
+        None is returned when no workflow has a job that can be dispatched.
+        '''
+        while self.heap:
+            (_, _, entry, name) = heappop(self.heap)
+            share = self.workflows.get(name)
+
+            if share is None or share.entry != entry:
+                continue
+
+            share.entry = None
+
+            if self.max_running and self.running(name) >= self.max_running:
+                continue
+
+            user = self._user(name, share)
+            self.clock = max(self.clock, share.vtime)
+            share.vtime += self.users[user] / self.shares.get(user, 1.0)
+            job = share.jobs.popleft()
+            self.size -= 1
+
+            if share.jobs:
+                self._push(name, share)
+            else:
+                self._leave(user)
+                del self.workflows[name]
+
+            return (name, job, share.priority)
+
+        return None
+
+    def _push(self, name, share):
+        '''Adds the workflow to the heap of workflows with queued jobs'''
+        share.entry = next(self.sequence)
+        heappush(self.heap, (-share.priority, share.vtime, share.entry, name))
+
+    def _leave(self, user):
+        '''Removes a workflow with queued jobs from the count of the user'''
+        self.users[user] -= 1
+
+        if not self.users[user]:
+            del self.users[user]
+
+    def _user(self, name, share):
+        '''Returns the user the workflow is shared with'''
+        if share.user is None:
+            return name
+
+        return share.user
@@ -8,7 +8,12 @@ class Service(object):
         '''Initializes the service'''
 
     def update(self):
-        '''Update callback performed by the service.'''
+        '''
+        Update callback performed by the service.
+
+        Returns the number of events handled so the caller can tell an idle
+        service from a busy one.
+        '''
 
     def stop(self):
         '''Stops the service'''
@@ -1,9 +1,15 @@
 # -*- coding: utf-8 -*-
+from collections import OrderedDict
 from contextlib import contextmanager
 from functools import wraps
+from Queue import Queue, Empty
+from stat import S_ISDIR, S_ISREG
+from threading import Thread
+from time import time
 import logging
 import os
-import UserDict
+
+logger = logging.getLogger('yerba.utils')
 
 @contextmanager
 def ignored(*exceptions):
@@ -20,27 +26,225 @@ def meminfo():
         return dict([[item.strip() for item in line.rstrip("\n").split(":")]
             for line in fp])
 
-class ChainMap(UserDict.DictMixin):
-    def __init__(self, *maps):
-        self._maps = maps
-
-    def __getitem__(self, key):
-        for mapping in self._maps:
-            with ignored(KeyError):
-                item = mapping[key]
-                return item
-
-        raise KeyError(key)
-
-    def __setitem__(self, key, value):
-        self._maps[0][key] = value
-
 class YerbaError(Exception):
     def __init__(self, msg):
         self._msg = msg
     def __str__(self):
         return repr(self._msg)
 
+class StatCache(object):
+    """
+    A size bounded cache of file stats that expire after a time to live
+
+    Missing files are cached as well so repeated checks of an input that
+    does not exist yet do not reach the filesystem.
+    """
+
+    def __init__(self, ttl=5.0, size=100000):
+        self.ttl = ttl
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def configure(self, ttl=None, size=None):
+        """
+        Updates the time to live and the maximum number of entries
+        """
+        if ttl is not None:
+            self.ttl = ttl
+
+        if size is not None:
+            self.size = size
+
+        self.clear()
+
+    def stat(self, path):
+        """
+        Returns the stat of the path or None if the path does not exist
+        """
+        now = time()
+        entry = self._entries.get(path)
+
+        if entry is not None and entry[0] > now:
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+
+        try:
+            result = os.stat(path)
+        except OSError:
+            result = None
+
+        if entry is not None:
+            del self._entries[path]
+        elif len(self._entries) >= self.size:
+            self._entries.popitem(last=False)
+
+        self._entries[path] = (now + self.ttl, result)
+        return result
+
+    def isfile(self, path):
+        """
+        Returns whether the path is a regular file
+        """
+        result = self.stat(path)
+        return result is not None and S_ISREG(result.st_mode)
+
+    def isdir(self, path):
+        """
+        Returns whether the path is a directory
+        """
+        result = self.stat(path)
+        return result is not None and S_ISDIR(result.st_mode)
+
+    def invalidate(self, paths):
+        """
+        Removes the paths from the cache
+        """
+        for path in paths:
+            self._entries.pop(path, None)
+
+    def clear(self):
+        """
+        Removes every path from the cache
+        """
+        self._entries.clear()
+
+    def stats(self):
+        """
+        Returns the counters of the cache
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self._entries)
+        }
+
+#: Stat cache shared by every job
+stat_cache = StatCache()
+
+class LogWriter(object):
+    """
+    Appends lines to log files from a background thread
+
+    Writes are buffered in a bounded queue and block when the queue is full.
+    The most recently used files are kept open and flushed periodically.
+    Until the writer is started every write is appended immediately.
+    """
+
+    def __init__(self, size=10000, handles=64, interval=1.0):
+        self.size = size
+        self.max_handles = handles
+        self.interval = interval
+        self.queue = None
+        self.thread = None
+        self._handles = OrderedDict()
+
+    def configure(self, size=None, handles=None, interval=None):
+        """
+        Updates the queue size, open file limit and flush interval
+        """
+        if size is not None:
+            self.size = size
+
+        if handles is not None:
+            self.max_handles = handles
+
+        if interval is not None:
+            self.interval = interval
+
+    def start(self):
+        """
+        Starts the background thread
+        """
+        if self.thread is not None:
+            return
+
+        self.queue = Queue(self.size)
+        self.thread = Thread(target=self._run, name="log-writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Writes every queued message and stops the background thread
+        """
+        if self.thread is None:
+            return
+
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+
+    def write(self, path, lines):
+        """
+        Appends the lines to the file at path
+        """
+        if self.thread is None:
+            with open(path, 'a') as handle:
+                handle.writelines(lines)
+        else:
+            self.queue.put((path, lines))
+
+    def _run(self):
+        flushed = time()
+
+        while True:
+            try:
+                item = self.queue.get(timeout=self.interval)
+            except Empty:
+                item = ()
+
+            if item is None:
+                break
+
+            if item:
+                (path, lines) = item
+
+                try:
+                    self._handle(path).writelines(lines)
+                except (IOError, OSError):
+                    logger.exception("The log %s could not be written.", path)
+
+            if time() - flushed >= self.interval:
+                self._flush()
+                flushed = time()
+
+        self._flush()
+
+        for handle in self._handles.values():
+            handle.close()
+
+        self._handles.clear()
+
+    def _handle(self, path):
+        """
+        Returns the open file for path closing the least recently used
+        """
+        handle = self._handles.pop(path, None)
+
+        if handle is None:
+            if len(self._handles) >= self.max_handles:
+                (_, oldest) = self._handles.popitem(last=False)
+                oldest.close()
+
+            handle = open(path, 'a')
+
+        self._handles[path] = handle
+        return handle
+
+    def _flush(self):
+        for (path, handle) in self._handles.items():
+            try:
+                handle.flush()
+            except (IOError, OSError):
+                logger.exception("The log %s could not be flushed.", path)
+
+#: Log writer shared by every workflow
+log_writer = LogWriter()
+
 def is_empty(path):
     """
     Return whether or not the file is empty
@@ -48,10 +252,12 @@ def is_empty(path):
     If the path is not a valid file an OSError
     will be raised.
     """
-    if not os.path.isfile(path):
+    result = stat_cache.stat(path)
+
+    if result is None or not S_ISREG(result.st_mode):
         raise OSError(2, "No such file", path)
 
-    return os.stat(path)[6] == 0
+    return result.st_size == 0
 
 def log_on_exception(exception, message, logger=logging.getLogger()):
     """
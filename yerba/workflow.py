@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
-from itertools import groupby
+from collections import Counter, defaultdict, deque
+from heapq import heappush, heappop
+from time import time
 import logging
 import os
 
@@ -41,8 +43,13 @@ def _format_args(args):
                          logger=logger)
 @utils.log_on_exception(IOError, "The job could not be written to the log.",
                          logger=logger)
-def log_job_info(log_file, job):
-    '''Log the results of a job'''
+def log_job_info(log_file, job, output=None):
+    '''
+    Log the results of a job
+
+    The full output of the job may be given when the info of the job only
+    holds the end of it.
+    '''
     outputs = []
     msg = (
         "Job: {cmd}\n"
@@ -56,20 +63,24 @@ def log_job_info(log_file, job):
         "{output}")
 
     for item in job.outputs:
-        if isinstance(item, list) and item[1]:
+        if isinstance(item, tuple) and item[1]:
             outputs.append(item[0])
         else:
             outputs.append(item)
 
     job.info['outputs'] = ', '.join(outputs)
     description = '{0}\n'.format(job.description)
-    body = msg.format(**job.info)
 
-    with open(log_file, 'a') as log_handle:
-        log_handle.write('#' * 25 + '\n')
-        log_handle.write(description)
-        log_handle.write(body)
-        log_handle.write('#' * 25 + '\n\n')
+    if output is None:
+        output = job.info.get('output', '')
+
+    body = msg.format(**dict(job.info, output=repr(output)))
+
+    utils.log_writer.write(log_file, [
+        '#' * 25 + '\n',
+        description,
+        body,
+        '#' * 25 + '\n\n'])
 
 @utils.log_on_exception(OSError, "The job could not be written to the log.",
                          logger=logger)
@@ -77,12 +88,12 @@ def log_job_info(log_file, job):
                          logger=logger)
 def log_skipped_job(log_file, job):
     '''Log a job that was skipped'''
-    with open(log_file, 'a') as log_handle:
-        log_handle.write('#' * 25 + '\n')
-        log_handle.write('{0}\n'.format(job.description))
-        log_handle.write("Job: %s\n" % str(job))
-        log_handle.write("Skipped: The analysis was previously generated.\n")
-        log_handle.write('#' * 25 + '\n\n')
+    utils.log_writer.write(log_file, [
+        '#' * 25 + '\n',
+        '{0}\n'.format(job.description),
+        "Job: %s\n" % str(job),
+        "Skipped: The analysis was previously generated.\n",
+        '#' * 25 + '\n\n'])
 
 @utils.log_on_exception(OSError, "The job could not be written to the log.",
                          logger=logger)
@@ -90,30 +101,79 @@ def log_skipped_job(log_file, job):
                          logger=logger)
 def log_not_run_job(log_file, job):
     '''Log a job that could not be run'''
+    utils.log_writer.write(log_file, [
+        '#' * 25 + '\n',
+        '{0}\n'.format(job.description),
+        "Job: %s\n" % str(job),
+        "The job was not run.\n",
+        '#' * 25 + '\n\n'])
+
+#: Options of a job that sets none of its own
+DEFAULT_OPTIONS = {
+    "allow-zero-length" : True,
+    "retries" : 0,
+    "cores" : None,
+    "memory" : None,
+    "disk" : None,
+    "category" : None
+}
+
+#: Options giving the resources a job needs, memory and disk are in MB
+RESOURCES = ('cores', 'memory', 'disk')
+
+def _intern(value):
+    """Returns the shared copy of the string"""
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+
+    return intern(str(value))
+
+def _entry(fp):
+    """
+    Returns the compact form of an input or output
+
+    Paths are interned so that every job and workflow refers to the same
+    string. Directories given as a list are stored as a tuple.
+    """
+    if isinstance(fp, list):
+        return (_intern(fp[0]),) + tuple(fp[1:])
+
+    return _intern(fp)
 
-    with open(log_file, 'a') as log_handle:
-        log_handle.write('#' * 25 + '\n')
-        log_handle.write('{0}\n'.format(job.description))
-        log_handle.write("Job: %s\n" % str(job))
-        log_handle.write("The job was not run.\n")
-        log_handle.write('#' * 25 + '\n\n')
+def _path(fp):
+    """Returns the absolute path of an input or output"""
+    if isinstance(fp, tuple):
+        return os.path.abspath(fp[0])
+
+    return os.path.abspath(fp)
+
+def _freeze(paths):
+    """Returns a sorted and hashable copy of the paths"""
+    return tuple(sorted(paths))
 
 class Job(object):
+    __slots__ = ('cmd', 'script', 'args', 'inputs', 'outputs', '_status',
+                 'description', '_info', '_fingerprint', 'attempts',
+                 'allow_zero_length', 'retries', 'cores', 'memory', 'disk',
+                 'category')
+
     def __init__(self, cmd, script, arguments, description=''):
-        self.cmd = cmd
+        self.cmd = _intern(cmd)
         self.script = script
         self.args = arguments
-        self.inputs = []
-        self.outputs = []
+        self.inputs = ()
+        self.outputs = ()
         self._status = SCHEDULED
         self.description = description
-        self._info = {}
-        self._errors = []
+        self._info = None
+        self._fingerprint = None
         self.attempts = 1
-        self._options = {
-            "allow-zero-length" : True,
-            "retries" : 0
-        }
+        self.allow_zero_length = DEFAULT_OPTIONS["allow-zero-length"]
+        self.retries = DEFAULT_OPTIONS["retries"]
+        self.cores = DEFAULT_OPTIONS["cores"]
+        self.memory = DEFAULT_OPTIONS["memory"]
+        self.disk = DEFAULT_OPTIONS["disk"]
+        self.category = DEFAULT_OPTIONS["category"]
 
     @classmethod
     def from_object(cls, job_object):
@@ -137,11 +197,11 @@ class Job(object):
 
         # Add inputs
         inputs = job_object.get('inputs', []) or []
-        new_job.inputs.extend(sorted(inputs))
+        new_job.inputs = tuple(_entry(fp) for fp in sorted(inputs))
 
         # Add outputs
         outputs = job_object.get('outputs', []) or []
-        new_job.outputs.extend(sorted(outputs))
+        new_job.outputs = tuple(_entry(fp) for fp in sorted(outputs))
 
         if 'overwrite' in job_object and int(job_object['overwrite']):
             logger.debug(("The job will overwrite previous"
@@ -152,14 +212,44 @@ class Job(object):
 
     @property
     def options(self):
-        return self._options
+        return {
+            "allow-zero-length" : self.allow_zero_length,
+            "retries" : self.retries,
+            "cores" : self.cores,
+            "memory" : self.memory,
+            "disk" : self.disk,
+            "category" : self.category
+        }
 
     @options.setter
     def options(self, options):
         """
         Updates the options to be used by the job
+
+        The given options override the current ones and are resolved into
+        attributes so that they are not looked up for every file checked.
         """
-        self._options = utils.ChainMap(options, self._options)
+        self.allow_zero_length = options.get("allow-zero-length",
+                                             self.allow_zero_length)
+        self.retries = options.get("retries", self.retries)
+        self.cores = options.get("cores", self.cores)
+        self.memory = options.get("memory", self.memory)
+        self.disk = options.get("disk", self.disk)
+        self.category = options.get("category", self.category)
+
+    @property
+    def fingerprint(self):
+        """
+        Returns the canonical identity of the job.
+
+        The fingerprint is built from the command, arguments, inputs and
+        outputs the first time it is requested.
+        """
+        if self._fingerprint is None:
+            self._fingerprint = (self.cmd, self.args, _freeze(self.inputs),
+                                 _freeze(self.outputs))
+
+        return self._fingerprint
 
     @property
     def status(self):
@@ -172,6 +262,9 @@ class Job(object):
 
     @property
     def info(self):
+        if self._info is None:
+            return {}
+
         return self._info
 
     @info.setter
@@ -189,7 +282,8 @@ class Job(object):
             ['description', self.description],
             ['cmd',         self.cmd + self.args],  # mdb added 10/13/16
             ['inputs',      self.inputs],           # mdb added 10/13/16
-            ['outputs',     self.outputs]           # mdb added 10/13/16
+            ['outputs',     self.outputs],          # mdb added 10/13/16
+            ['attempts',    self.attempts]
         ]
 
         status.extend(self.info.items())
@@ -202,6 +296,12 @@ class Job(object):
             with utils.ignored(OSError):
                 os.remove(output)
 
+        self.invalidate()
+
+    def invalidate(self):
+        '''Removes the outputs of the job from the stat cache'''
+        utils.stat_cache.invalidate(_path(fp) for fp in self.outputs)
+
     def running(self):
         return self._status == 'running'
 
@@ -209,41 +309,48 @@ class Job(object):
         '''Returns whether or not the job was completed.'''
 
         for fp in self.outputs:
-            if isinstance(fp, list) and fp[1]:
-                val = os.path.abspath(str(fp[0]))
+            if isinstance(fp, tuple) and fp[1]:
+                val = os.path.abspath(fp[0])
 
-                if not os.path.isdir(val):
+                if not utils.stat_cache.isdir(val):
                     return False
 
-            elif self.options["allow-zero-length"]:
-                path = os.path.abspath(str(fp))
+            elif self.allow_zero_length:
+                path = os.path.abspath(fp)
 
-                if not os.path.isfile(path):
+                if not utils.stat_cache.isfile(path):
                     return False
             else:
-                path = os.path.abspath(str(fp))
-                if not os.path.isfile(path) or utils.is_empty(path):
+                path = os.path.abspath(fp)
+                if not utils.stat_cache.isfile(path) or utils.is_empty(path):
                     return False
 
         return True
 
-    def ready(self):
-        '''Returns that the job has its input files and is ready.'''
-        for fp in self.inputs:
-            if isinstance(fp, list) and fp[1]:
-                val = os.path.abspath(str(fp[0]))
+    def ready(self, inputs=None):
+        '''
+        Returns that the job has its input files and is ready.
+
+        When inputs is given only that subset of the inputs is checked.
+        '''
+        if inputs is None:
+            inputs = self.inputs
+
+        for fp in inputs:
+            if isinstance(fp, tuple) and fp[1]:
+                val = os.path.abspath(fp[0])
 
-                if not os.path.isdir(val):
+                if not utils.stat_cache.isdir(val):
                     return False
-            elif self.options["allow-zero-length"]:
-                path = os.path.abspath(str(fp))
+            elif self.allow_zero_length:
+                path = os.path.abspath(fp)
 
-                if not os.path.isfile(path):
+                if not utils.stat_cache.isfile(path):
                     return False
             else:
-                path = os.path.abspath(str(fp))
+                path = os.path.abspath(fp)
 
-                if not os.path.isfile(path) or utils.is_empty(path):
+                if not utils.stat_cache.isfile(path) or utils.is_empty(path):
                     return False
 
         return True
@@ -252,12 +359,16 @@ class Job(object):
         self.attempts = self.attempts + 1
 
     def failed(self):
-        return self.attempts > self.options['retries']
+        return self.attempts > self.retries
 
     def __eq__(self, other):
-        return (sorted(other.inputs) == sorted(self.inputs) and
-                sorted(other.outputs) == sorted(self.outputs) and
-                str(other) == str(self))
+        return self.fingerprint == other.fingerprint
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.fingerprint)
 
     def __repr__(self):
         return ' '.join([self.cmd, self.args])
@@ -266,41 +377,148 @@ class Job(object):
         return repr(self)
 
 #FIXME: states for jobs should be decoupled from jobs
-#TODO: Add proper dependency management to jobs
 class Workflow(object):
-    def __init__(self, name, jobs, log=None, priority=0):
+    #: Seconds before the first retry of a job, doubled for every attempt
+    #: up to the max_retry_delay
+    retry_delay = 30
+    max_retry_delay = 3600
+
+    #: Epoch given to the last workflow created
+    last_epoch = 0
+
+    def __init__(self, name, jobs, log=None, priority=0, user=None):
         self.name = name
         self.log = log
         self.priority = priority
+        self.user = user
         self.jobs = tuple(jobs)
-        self.available = jobs
-        self.running = []
-        self.completed = []
+
+        #: Indices of the jobs that have not been run
+        self.available = set(range(len(self.jobs)))
+
+        #: Indices of the jobs that are running
+        self.running = set()
+
+        #: Indices of the jobs that have finished
+        self.completed = set()
+
+        #: Number of jobs in each state
+        self.counts = Counter(job.status for job in self.jobs)
+
+        #: Index of the job changed by each version of the workflow
+        self.history = []
+
+        #: Versions start from the time the workflow was created in
+        #: microseconds so that a workflow generated again by a restart,
+        #: resubmit or resume never reuses the versions of the previous one
+        self.epoch = max(int(time() * 1000000), Workflow.last_epoch + 1)
+        Workflow.last_epoch = self.epoch
+
+        #: Heap of the jobs waiting to be retried by when they are due
+        self.retrying = []
+
         self.status = core.Status.Initialized
+        self._build_graph()
+
+    def _build_graph(self):
+        """
+        Builds the dependencies between jobs from their inputs and outputs.
+
+        A job depends on each job of the workflow that produces one of its
+        inputs. The remaining inputs are external to the workflow and are the
+        only inputs checked on the filesystem before a job is run.
+        """
+        producers = {}
 
-    def update_status(self, job, info):
+        for (index, job) in enumerate(self.jobs):
+            for fp in job.outputs:
+                producers[_path(fp)] = index
+
+        #: Jobs that depend on the outputs of each job
+        self.dependents = [[] for job in self.jobs]
+
+        #: Number of producers each job is still waiting on
+        self.unmet = [0] * len(self.jobs)
+
+        #: Inputs of each job that are not produced by the workflow
+        self.external = []
+
+        #: Indices of the jobs with each fingerprint
+        self.indices = defaultdict(list)
+
+        for (index, job) in enumerate(self.jobs):
+            depends = set()
+            external = []
+
+            for fp in job.inputs:
+                producer = producers.get(_path(fp))
+
+                if producer is None or producer == index:
+                    external.append(fp)
+                else:
+                    depends.add(producer)
+
+            for producer in depends:
+                self.dependents[producer].append(index)
+
+            self.unmet[index] = len(depends)
+            self.external.append(external)
+            self.indices[job.fingerprint].append(index)
+
+        #: Jobs whose producers have all finished
+        self.released = deque(index for (index, count) in enumerate(self.unmet)
+                              if not count)
+
+        #: Jobs that are waiting on external inputs
+        self.blocked = []
+
+    def update_status(self, job, info, output=None):
         '''Updates the status of the workflow'''
+        #: The job may have been scheduled by an identical job of another
+        #: workflow so the running jobs of this workflow are updated
+        indices = [index for index in self.indices.get(job.fingerprint, [])
+                   if self.jobs[index].status == RUNNING]
+
+        if not indices:
+            logger.warn("WORKFLOW %s: the job %s is not running",
+                        self.name, job)
+
+        for index in indices:
+            self._update_job(index, info, output)
+
+        return self.status
+
+    def _update_job(self, index, info, output):
+        '''Updates the status of the job and the workflow'''
+        job = self.jobs[index]
+
         #: Assign the info object to the job
         job.info = info
 
-        #: Remove the job from the running list
-        self.running.remove(job)
+        #: Remove the job from the running jobs
+        self.running.discard(index)
 
         #FIXME: add workflow change events
         #: Update the workflow log
         if self.log:
-            log_job_info(self.log, job)
+            log_job_info(self.log, job, output)
 
         #: Check that job returned successfully
         if info['returned'] != 0 or not job.completed():
-            job.status = FAILED
+            #: Retry jobs that could not be run on a worker
+            if self._retry(index, info):
+                return self.status
+
+            self._set_status(index, FAILED)
             self._failed()
-            self.completed.append(job)
+            self.completed.add(index)
             self.status = core.Status.Failed
             return self.status
 
-        #: Update the status to completed
-        job.status = COMPLETED
+        #: Update the status to completed and release its dependents
+        self._set_status(index, COMPLETED)
+        self.completed.add(index)
+        self._release(index)
 
         #: Check if the workflow is already in a finished state
         if self.status in core.DONE_STATUS:
@@ -320,31 +538,92 @@ class Workflow(object):
             self.status = core.Status.Failed
             return self.status
 
+    def _retry(self, index, info):
+        '''
+        Schedules the job to be run again after a delay
+
+        Only jobs that failed on the worker rather than in their command,
+        which work queue reports as retryable, are retried up to the retries
+        of the job. Returns whether or not the job will be retried.
+        '''
+        job = self.jobs[index]
+
+        if not info.get('retryable') or job.failed():
+            return False
+
+        if self.status in core.DONE_STATUS:
+            return False
+
+        job.restart()
+        delay = min(self.retry_delay * 2 ** (job.attempts - 2),
+                    self.max_retry_delay)
+
+        logger.info("WORKFLOW %s: retrying job %s in %s seconds (attempt %s)",
+                    self.name, job, delay, job.attempts)
+
+        self._set_status(index, WAITING)
+        self.available.add(index)
+        heappush(self.retrying, (time() + delay, index))
+        return True
+
+    def _release(self, index):
+        '''Releases the jobs waiting only on the finished job'''
+        for dependent in self.dependents[index]:
+            self.unmet[dependent] -= 1
+
+            if not self.unmet[dependent]:
+                self.released.append(dependent)
+
     def next(self):
-        '''Return the next set of available jobs'''
+        '''
+        Return the next set of available jobs
+
+        Only jobs that were released since the last call and jobs waiting on
+        external inputs are checked.
+        '''
         available = []
-        skipped = []
 
         #: Check if the workflow is already in a finished state
         if self.status in core.DONE_STATUS:
             return available
 
-        for job in self.available:
-            if job.outputs and job.completed():
-                skipped.append(job)
+        candidates = self.blocked
+        self.blocked = []
+        now = time()
+
+        #: Jobs being retried are run again once their delay has passed
+        while self.retrying and self.retrying[0][0] <= now:
+            (_, index) = heappop(self.retrying)
+
+            if self.jobs[index].status == WAITING:
+                candidates.append(index)
+
+        #: Skipping a job releases its dependents into the queue
+        while self.released:
+            index = self.released.popleft()
+            job = self.jobs[index]
+
+            if job.status not in READY_STATES:
                 continue
 
-            if job.ready() and job.status in READY_STATES:
-                self.available.remove(job)
-                self.running.append(job)
-                available.append(job)
-                job.status = RUNNING
+            if job.outputs and job.completed():
+                self._skip(index)
+            else:
+                candidates.append(index)
 
-        for job in skipped:
-            self._skip(job)
+        for index in candidates:
+            job = self.jobs[index]
 
-        #: Check if any tasks are busy
-        if available or self.running:
+            if job.ready(self.external[index]):
+                self.available.discard(index)
+                self.running.add(index)
+                available.append(job)
+                self._set_status(index, RUNNING)
+            else:
+                self.blocked.append(index)
+
+        #: Check if any tasks are busy or waiting to be retried
+        if available or self.running or self.retrying:
             self.status = core.Status.Running
         elif not self.available:
             #: Check if all jobs have been skipped
@@ -359,22 +638,55 @@ class Workflow(object):
         ''' Sets the state of the workflow as cancelled'''
         self.status = core.Status.Cancelled
 
-        for job in self.available + self.running:
-            if job in RUNNING_STATES:
-                job.status = CANCELLED
+        for index in self.available | self.running:
+            job = self.jobs[index]
+
+            if job.status in RUNNING_STATES:
+                self._set_status(index, CANCELLED)
 
     def stop(self):
         ''' Sets the state of the workflow as stopped'''
         self.status = core.Status.Stopped
 
-        for job in self.available + self.running:
-            if job in RUNNING_STATES:
-                job.status = STOPPED
+        for index in self.available | self.running:
+            job = self.jobs[index]
+
+            if job.status in RUNNING_STATES:
+                self._set_status(index, STOPPED)
+
+    @property
+    def version(self):
+        """Returns the version of the jobs, counting up from the epoch"""
+        return self.epoch + len(self.history)
 
     def state(self):
         """Returns the state of the workflow"""
         return [job.state for job in self.jobs]
 
+    def changes(self, since):
+        """
+        Returns the indices of the jobs changed after the version
+
+        Every job is returned when the version is not one of this workflow.
+        """
+        if not self.epoch <= since <= self.version:
+            return range(len(self.jobs))
+
+        return sorted(set(self.history[since - self.epoch:]))
+
+    def summary(self):
+        """Returns the number of jobs in each state"""
+        return {state: count for (state, count) in self.counts.iteritems()
+                if count}
+
+    def _set_status(self, index, status):
+        """Moves the job into the status and records the change"""
+        job = self.jobs[index]
+        self.counts[job.status] -= 1
+        self.counts[status] += 1
+        self.history.append(index)
+        job.status = status
+
     def _finished(self):
         """Returns True when all jobs have been finished"""
         return not self.available and not self.running
@@ -383,48 +695,53 @@ class Workflow(object):
         """
         Returns whether the workflow can continue.
         """
-        #: Get the number of running jobs
-        total_running = len(self.running)
-
-        #: Check if any jobs are still waiting
-        waiting = [job for job in self.available if job.status in READY_STATES]
+        #: Proceed if a job is running, has been released or will be retried
+        if self.running or self.released or self.retrying:
+            return True
 
-        #: Get the number of ready jobs
-        total_ready = len([job for job in waiting if job.ready()]) > 0
-
-        #: Proceed if a job is running or a job is ready
-        return total_ready or total_running
+        #: Proceed if a job waiting on external inputs is ready
+        return any(self.jobs[index].ready(self.external[index])
+                   for index in self.blocked)
 
     def _failed(self):
-        '''Sets a job into the failed state'''
-        for job in self.available:
-            job.status = FAILED
+        '''
+        Sets the jobs that have not been run into the failed state
+
+        The jobs still running are dropped along with the jobs waiting to be
+        retried and are not run either.
+        '''
+        for index in self.available | self.running:
+            job = self.jobs[index]
+            self._set_status(index, FAILED)
             #FIXME: add workflow change events
             #: Update the workflow log
             if self.log:
                 log_not_run_job(self.log, job)
 
-    def _skip(self, job):
+        self.completed.update(self.available)
+        self.completed.update(self.running)
+        self.available.clear()
+        self.running.clear()
+        del self.retrying[:]
+
+    def _skip(self, index):
         '''Sets a job into a skipped state'''
-        job.status = SKIPPED
-        self.available.remove(job)
-        self.completed.append(job)
+        job = self.jobs[index]
+        self._set_status(index, SKIPPED)
+        self.available.discard(index)
+        self.completed.add(index)
+        self._release(index)
 
         #: Update the workflow log
         if self.log:
             log_skipped_job(self.log, job)
 
     def status_message(self):
-        prefix = "WORKFLOW{0}: " % self.name
-        states = sorted(job.state for job in self.available + self.completed)
-
-        #: summarize the number of jobs in each state
-        fields = [",".join([state, len(jobs)]) for state,jobs in groupby(states)]
-
-        #: summary of the workflows status
-        summary = " ".join(fields)
+        """Returns a line with the number of jobs in each state"""
+        fields = ["{0},{1}".format(state, count)
+                  for (state, count) in sorted(self.summary().items())]
 
-        return prefix + summary
+        return "WORKFLOW {0}: {1}\n".format(self.name, " ".join(fields))
 
     @classmethod
     def from_object(cls, workflow_object):
@@ -456,7 +773,8 @@ class Workflow(object):
             raise WorkflowError("%s jobs where not valid." % len(errors), errors)
 
         jobs = [Job.from_object(job_object) for job_object in job_objects]
-        workflow = cls(name, jobs, log=logfile, priority=level)
+        workflow = cls(name, jobs, log=logfile, priority=level,
+                       user=workflow_object.get('user'))
         logger.info("WORKFLOW %s has been generated.", name)
         return workflow
 
@@ -495,6 +813,34 @@ def validate_job(job_object):
     if any(fp is None for fp in outputs):
         return (False, "An output was invalid")
 
+    options = job_object.get('options', {})
+
+    if not isinstance(options, dict):
+        return (False, "The job expected a dictionary of options")
+
+    for resource in RESOURCES:
+        value = options.get(resource)
+
+        if value is None:
+            continue
+
+        if (isinstance(value, bool) or not isinstance(value, (int, long))
+                or value <= 0):
+            return (False, "The %s option must be a positive integer"
+                    % resource)
+
+    retries = options.get('retries')
+
+    if retries is not None and (isinstance(retries, bool) or
+            not isinstance(retries, (int, long)) or retries < 0):
+        return (False, "The retries option must be a non-negative integer")
+
+    category = options.get('category')
+
+    if category is not None and not (
+            isinstance(category, basestring) and category.strip()):
+        return (False, "The category option must be a name")
+
     return (True, "The job has been validated")
 
 class WorkflowError(Exception):
@@ -1,19 +1,62 @@
 # -*- coding: utf-8 -*-
 from __future__ import division
 
+from collections import defaultdict
 from datetime import datetime
 from logging import getLogger
 from os.path import abspath, basename
 from sys import exit
+from time import time
 
 import work_queue as wq
 
 from yerba.core import TASK_DONE
+from yerba.scheduler import FairScheduler, parse_shares
 from yerba.services import Service
 
 logger = getLogger('yerba.workqueue')
 name = "yerba"
 MAX_OUTPUT = 65536
+BATCH_SIZE = 1000
+BATCH_TIME = 100
+MAX_TASKS = 10000
+MAX_WAITING = 100
+
+#: Allocation modes of the resources of a task category
+CATEGORY_MODES = {
+    'fixed': 'WORK_QUEUE_ALLOCATION_MODE_FIXED',
+    'max': 'WORK_QUEUE_ALLOCATION_MODE_MAX',
+    'min_waste': 'WORK_QUEUE_ALLOCATION_MODE_MIN_WASTE',
+    'max_throughput': 'WORK_QUEUE_ALLOCATION_MODE_MAX_THROUGHPUT',
+}
+
+def _results(*names):
+    '''Returns the values of the task results known to work_queue'''
+    return [getattr(wq, 'WORK_QUEUE_RESULT_' + name) for name in names
+            if hasattr(wq, 'WORK_QUEUE_RESULT_' + name)]
+
+#: Results of tasks that failed on the worker rather than in their command
+RETRY_RESULTS = frozenset(_results('RESOURCE_EXHAUSTION', 'TASK_TIMEOUT',
+                                   'FORSAKEN', 'DISK_ALLOC_FULL'))
+
+#: Flags of the results of tasks whose inputs could not be transferred and
+#: of those whose outputs are missing
+TRANSFER_FLAGS = sum(_results('INPUT_MISSING'))
+OUTPUT_FLAG = sum(_results('OUTPUT_MISSING'))
+
+def is_retryable(task):
+    '''
+    Returns whether the task failed on the worker rather than in its command
+
+    Missing outputs are only blamed on the worker when the command returned
+    successfully, since a failed command usually leaves its outputs unwritten.
+    '''
+    result = task.result or 0
+
+    if result in RETRY_RESULTS or result & TRANSFER_FLAGS:
+        return True
+
+    return bool(result & OUTPUT_FLAG) and task.return_status == 0
 
 def get_task_info(task):
     dateformat="%d/%m/%y at %I:%M:%S%p"
@@ -33,7 +76,9 @@ def get_task_info(task):
         'elapsed' : execution_time,
         'taskid' : task.id,
         'returned' : task.return_status,
-        'output' : repr(task.output[:MAX_OUTPUT]),
+        'result' : task.result,
+        'retryable' : is_retryable(task),
+        'output' : (task.output or '')[:MAX_OUTPUT],
     }
 
 class WorkQueueService(Service):
@@ -44,6 +89,12 @@ class WorkQueueService(Service):
         self.tasks = {}
         self.notifier = notifier
 
+        #: Index of the task assigned to each job fingerprint
+        self.fingerprints = {}
+
+        #: Index of the tasks each workflow depends on
+        self.workflow_tasks = defaultdict(set)
+
         try:
             self.project = config['project']
             self.catalog_server = config['catalog_server']
@@ -51,9 +102,37 @@ class WorkQueueService(Service):
             self.port = int(config['port'])
             self.log = config['log']
 
+            #: Limits on the number of tasks and the time in milliseconds
+            #: spent collecting completed tasks in a single update
+            self.batch_size = int(config.get('batch_size', BATCH_SIZE))
+            self.batch_time = int(config.get('batch_time', BATCH_TIME)) / 1000.0
+
+            #: Most tasks submitted to work queue at once (0 for no limit)
+            #: and most tasks left waiting for a worker beyond the number of
+            #: workers that are ready
+            self.max_tasks = int(config.get('max_tasks', MAX_TASKS))
+            self.max_waiting = int(config.get('max_waiting', MAX_WAITING))
+
+            #: Tasks waiting for a worker as of the last dispatch
+            self.waiting = 0
+
+            #: Allocation mode of every task category and the categories
+            #: that have been given the mode
+            mode = config.get('category_mode')
+            self.category_mode = None
+            self.categories = set()
+
+            if mode:
+                self.category_mode = getattr(wq, CATEGORY_MODES[mode])
+
+            #: Ready jobs are held until work queue has room for tasks
+            self.scheduler = FairScheduler(self._running,
+                max_running=int(config.get('max_workflow_tasks', 0)),
+                shares=parse_shares(config.get('shares')))
+
             if config['debug']:
                 wq.set_debug_flag('all')
-        except KeyError:
+        except (KeyError, AttributeError, ValueError):
             logger.exception("Invalid workqueue configuration")
             exit(1)
 
@@ -70,6 +149,11 @@ class WorkQueueService(Service):
                     self.catalog_port)
             self.queue.specify_log(self.log)
 
+            #: Resources of categories are labeled from the measured usage
+            #: of their tasks
+            if self.category_mode is not None:
+                self.queue.enable_monitoring()
+
             logger.info('WORKQUEUE %s: Starting work queue on port %s',
                     self.project, self.queue.port)
         except Exception:
@@ -84,79 +168,187 @@ class WorkQueueService(Service):
                 self.project, self.queue.port)
         self.queue.shutdown_workers(0)
 
-    def schedule(self, iterable, name, priority=None):
+    def schedule(self, iterable, name, priority=None, user=None):
         '''
-        Schedules jobs into work_queue
+        Queues the jobs of the workflow to be scheduled into work_queue
+
+        Jobs that are already assigned to a task wait on that task.
+        '''
+        queued = [new_job for new_job in iterable
+                  if not self._assign(name, new_job)]
+
+        self.scheduler.add(name, queued, priority=priority, user=user)
+
+    def dispatch(self):
         '''
-        logger.info("######### WORKQUEUE SCHEDULING ##########")
-        for new_job in iterable:
-            logger.info('WORKQUEUE %s: The workflow %s is scheduling job %s', self.project, name, new_job)
+        Submits queued jobs to work_queue while it has room for tasks
 
-            if not new_job.ready():
-                logger.info('WORKFLOW %s: Job %s was not scheduled waiting on inputs', name, new_job)
-                continue
+        Tasks are submitted until max_tasks are outstanding or the tasks
+        waiting for a worker exceed max_waiting plus the workers that are
+        ready. Returns the number of jobs dispatched.
+        '''
+        stats = self.queue.stats
+        waiting = stats.tasks_waiting
+        room = self.max_waiting + stats.workers_ready
+        dispatched = 0
 
-            skip = False
+        while waiting < room and not self._full():
+            item = self.scheduler.pop()
 
-            for (taskid, item) in self.tasks.items():
-                (names, job) = item
-                if new_job == job:
-                    if name not in names:
-                        names.append(name)
+            if item is None:
+                break
 
-                    logger.info(('WORKQUEUE %s: This job has already been'
-                        'assigned to task %s'), self.project, taskid)
+            (name, new_job, priority) = item
+            dispatched += 1
 
-                    self.tasks[taskid] = (names, job)
-                    skip = True
-                    break
+            if not self._assign(name, new_job):
+                self._submit(name, new_job, priority)
+                waiting += 1
 
-            if skip:
-                continue
+        self.waiting = waiting
+        return dispatched
 
-            cmd = str(new_job)
-            task = wq.Task(cmd)
+    def depth(self):
+        '''
+        Returns the limits on submitted tasks and the number of jobs held
+        at each stage.
+        '''
+        return {
+            "max_tasks": self.max_tasks,
+            "max_waiting": self.max_waiting,
+            "tasks": len(self.tasks),
+            "waiting": self.waiting,
+            "queued": len(self.scheduler),
+        }
+
+    def _full(self):
+        '''
+        Returns whether the most tasks allowed have been submitted.
+        '''
+        return 0 < self.max_tasks <= len(self.tasks)
 
-            for input_file in new_job.inputs:
-                if isinstance(input_file, list) and input_file[1]:
-                    remote_input = basename(abspath(input_file[0]))
-                    task.specify_directory(str(input_file[0]), str(remote_input),
-                                    wq.WORK_QUEUE_INPUT, recursive=1)
-                else:
-                    remote_input = basename(abspath(input_file))
-                    task.specify_input_file(str(input_file), str(remote_input),
-                                    wq.WORK_QUEUE_INPUT)
+    def _assign(self, name, new_job):
+        '''
+        Assigns the job to the task already running an identical job
 
-            for output_file in new_job.outputs:
-                if isinstance(output_file, list):
-                    remote_output = basename(abspath(output_file[0]))
-                    task.specify_directory(str(output_file[0]), str(remote_output),
-                                    wq.WORK_QUEUE_OUTPUT, recursive=1, cache=False)
-                else:
-                    remote_output = basename(abspath(output_file))
-                    task.specify_file(str(output_file), str(remote_output),
-                                    wq.WORK_QUEUE_OUTPUT, cache=False)
+        Returns whether or not the job was assigned.
+        '''
+        taskid = self.fingerprints.get(new_job.fingerprint)
 
-            new_id = self.queue.submit(task)
+        if taskid is None:
+            return False
 
-            logger.info('WORKQUEUE %s: Task has been submited and assigned [id %s]', self.project, new_id)
+        (names, job) = self.tasks[taskid]
 
-            self.tasks[new_id] = ([name], new_job)
+        if name not in names:
+            names.append(name)
+            self.workflow_tasks[name].add(taskid)
 
-        logger.info("######### WORKQUEUE END SCHEDULING ##########")
+        logger.info(('WORKQUEUE %s: This job has already been'
+            'assigned to task %s'), self.project, taskid)
+        return True
 
-    def update(self):
+    def _submit(self, name, new_job, priority):
+        '''
+        Submits the job into work_queue as a new task
         '''
-        Updates the scheduled workflow.
+        logger.info('WORKQUEUE %s: The workflow %s is scheduling job %s',
+                    self.project, name, new_job)
+
+        cmd = str(new_job)
+        task = wq.Task(cmd)
+        task.specify_priority(priority or 0)
+        self._specify_resources(task, new_job)
+
+        for input_file in new_job.inputs:
+            if isinstance(input_file, tuple) and input_file[1]:
+                remote_input = basename(abspath(input_file[0]))
+                task.specify_directory(str(input_file[0]), str(remote_input),
+                                wq.WORK_QUEUE_INPUT, recursive=1)
+            else:
+                remote_input = basename(abspath(input_file))
+                task.specify_input_file(str(input_file), str(remote_input),
+                                wq.WORK_QUEUE_INPUT)
+
+        for output_file in new_job.outputs:
+            if isinstance(output_file, tuple):
+                remote_output = basename(abspath(output_file[0]))
+                task.specify_directory(str(output_file[0]), str(remote_output),
+                                wq.WORK_QUEUE_OUTPUT, recursive=1, cache=False)
+            else:
+                remote_output = basename(abspath(output_file))
+                task.specify_file(str(output_file), str(remote_output),
+                                wq.WORK_QUEUE_OUTPUT, cache=False)
+
+        new_id = self.queue.submit(task)
+
+        logger.info('WORKQUEUE %s: Task has been submited and assigned [id %s]', self.project, new_id)
 
-        If a task is completed new tasks from the workflow will be scheduled.
+        self.tasks[new_id] = ([name], new_job)
+        self.fingerprints[new_job.fingerprint] = new_id
+        self.workflow_tasks[name].add(new_id)
+
+    def _specify_resources(self, task, job):
+        '''
+        Sets the resources and category of the task from the job.
         '''
-        task = self.queue.wait(0)
+        if job.cores:
+            task.specify_cores(job.cores)
+
+        if job.memory:
+            task.specify_memory(job.memory)
+
+        if job.disk:
+            task.specify_disk(job.disk)
 
-        if not task:
+        if not job.category:
             return
 
-        logger.info("######### WORKQUEUE UPDATING ##########")
+        category = str(job.category)
+        task.specify_category(category)
+
+        if self.category_mode is not None and category not in self.categories:
+            self.queue.specify_category_mode(category, self.category_mode)
+            self.categories.add(category)
+
+    def update(self):
+        '''
+        Updates the scheduled workflows.
+
+        Completed tasks are collected from the queue until none are left, the
+        batch size is reached or the time budget is spent. The completed jobs
+        of every workflow are notified together so that new tasks from each
+        workflow are scheduled once per batch and the batch is stored at once.
+        Queued jobs are then dispatched.
+        Returns the number of tasks that were completed and dispatched.
+        '''
+        completed = 0
+        results = defaultdict(list)
+        deadline = time() + self.batch_time
+
+        while completed < self.batch_size:
+            task = self.queue.wait(0)
+
+            if not task:
+                break
+
+            completed += 1
+            self._complete(task, results)
+
+            if time() > deadline:
+                break
+
+        if results:
+            logger.info("WORKQUEUE %s: %s tasks completed for %s workflows",
+                    self.project, completed, len(results))
+            self.notifier.notify(TASK_DONE, results)
+
+        return completed + self.dispatch()
+
+    def _complete(self, task, results):
+        '''
+        Adds the completed task to the results of each waiting workflow.
+        '''
         logger.info("WORKQUEUE %s: Fetching task from the work queue",
                 self.project)
 
@@ -168,47 +360,80 @@ class WorkQueueService(Service):
             logger.debug("Couldn't inspect the task")
 
         if task.id not in self.tasks:
-            logger.info(('WORKQUEUE %s: The job for id %s could ',
+            logger.info(('WORKQUEUE %s: The job for id %s could '
                 'not be found.'), self.project, task.id)
             return
 
-        (names, job) = self.tasks[task.id]
+        (names, job) = self.tasks.pop(task.id)
         info = get_task_info(task)
-        del self.tasks[task.id]
+        del self.fingerprints[job.fingerprint]
 
-        for workflow in names:
-            self.notifier.notify(TASK_DONE, workflow, job, info)
+        #: The outputs of the task have been written
+        job.invalidate()
 
-        logger.info("######### WORKQUEUE END UPDATING ##########")
+        for workflow in names:
+            self._release(workflow, task.id)
+            results[workflow].append((job, info))
 
     def cancel(self, name):
         '''
-        Removes the jobs based on there job id task id from the queue.
+        Removes the tasks of the workflow from the queue.
+
+        Tasks that other workflows depend on are kept in the queue.
         '''
-        for (taskid, item) in self.tasks.items():
-            (names, job) = item
+        cancelled = []
+        self.scheduler.remove(name)
+
+        for taskid in self.workflow_tasks.pop(name, ()):
+            (names, job) = self.tasks[taskid]
+            names.remove(name)
 
             logger.info('WORKFLOW %s: Requesting task %s to be cancelled',
                     name, taskid)
 
-            if name in names:
-                names.remove(name)
-            else:
-                continue
-
-            if not names:
-                task = self.queue.cancel_by_taskid(taskid)
-
-                if task:
-                    del self.tasks[taskid]
-                    logger.info("WORKQUEUE %s: The task %s was cancelled",
-                        self.project, task.taskid)
-                else:
-                    logger.error("WORKQUEUE %s: failed to cancel %s",
-                        self.project, taskid)
-            else:
+            if names:
                 msg = ('WORKQUEUE %s: The task %s was not cancelled '
                         'workflows %s depend on the task')
-                logger.info(msg, self.project, taskid, ', '.join(names))
-                self.tasks[taskid] = (names, job)
+                logger.info(msg, self.project, taskid,
+                            ', '.join(str(item) for item in names))
+            else:
+                cancelled.append(taskid)
 
+        self._cancel_tasks(cancelled)
+
+    def _cancel_tasks(self, taskids):
+        '''
+        Cancels the tasks that no workflow depends on.
+        '''
+        for taskid in taskids:
+            (_, job) = self.tasks.pop(taskid)
+            del self.fingerprints[job.fingerprint]
+
+            if self.queue.cancel_by_taskid(taskid):
+                logger.info("WORKQUEUE %s: The task %s was cancelled",
+                    self.project, taskid)
+            else:
+                logger.error("WORKQUEUE %s: failed to cancel %s",
+                    self.project, taskid)
+
+    def _release(self, name, taskid):
+        '''
+        Removes the task from the index of the workflow.
+        '''
+        taskids = self.workflow_tasks.get(name)
+
+        if taskids is None:
+            return
+
+        taskids.discard(taskid)
+
+        if not taskids:
+            del self.workflow_tasks[name]
+
+        self.scheduler.wake(name)
+
+    def _running(self, name):
+        '''
+        Returns the number of tasks the workflow is waiting on.
+        '''
+        return len(self.workflow_tasks.get(name, ()))